@@ -0,0 +1,145 @@
+"""API 请求限流 (按用户)
+
+根据 JWT 中的 user_id 为每个用户维护两个令牌桶：
+- telegram: 发送验证码、登录、手动检查等会访问 Telegram 的接口
+- read: 其它普通接口
+
+未登录的请求 (登录、注册) 按客户端 IP 限流。超出限制时返回 429 并带 Retry-After 头。
+"""
+import re
+import threading
+import time
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+import config
+from database import SessionLocal
+from log_config import user_id_var
+from profiling import stage
+from ratelimit import TokenBucket
+
+# 会访问 Telegram 的接口
+TELEGRAM_ROUTES = re.compile(r'^/api/accounts/(send-code|verify|check/\d+)$')
+
+# 不限流的接口
+EXEMPT_ROUTES = {'/api/health'}
+
+LIMITS = {
+    'read': (config.API_READ_RATE, config.API_READ_BURST),
+    'telegram': (config.API_TELEGRAM_RATE, config.API_TELEGRAM_BURST),
+}
+
+class MemoryBackend:
+    """进程内令牌桶"""
+    # 超过该数量时清理已回满的桶
+    MAX_BUCKETS = 10000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def consume(self, key: str, rate: float, capacity: float) -> float:
+        """尝试消耗一个令牌，成功返回 0，否则返回需要等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_BUCKETS:
+                    self._prune(now)
+                bucket = self._buckets[key] = TokenBucket(rate, capacity)
+
+            bucket.refill(now)
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0.0
+            return (1 - bucket.tokens) / rate
+
+    def _prune(self, now: float):
+        for key, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._buckets[key]
+
+class PostgresBackend:
+    """基于 api_rate_limits 表的共享令牌桶，每次判断为一条原子语句"""
+    CONSUME_SQL = text("""
+        INSERT INTO api_rate_limits (key, tokens, updated_at)
+        VALUES (:key, :capacity - 1, now())
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = LEAST(:capacity, api_rate_limits.tokens
+                + EXTRACT(EPOCH FROM now() - api_rate_limits.updated_at) * :rate) - 1,
+            updated_at = now()
+        WHERE LEAST(:capacity, api_rate_limits.tokens
+            + EXTRACT(EPOCH FROM now() - api_rate_limits.updated_at) * :rate) >= 1
+        RETURNING tokens
+    """)
+
+    TOKENS_SQL = text("""
+        SELECT LEAST(:capacity, tokens + EXTRACT(EPOCH FROM now() - updated_at) * :rate)
+        FROM api_rate_limits WHERE key = :key
+    """)
+
+    def consume(self, key: str, rate: float, capacity: float) -> float:
+        params = {"key": key, "rate": rate, "capacity": capacity}
+        db = SessionLocal()
+        try:
+            row = db.execute(self.CONSUME_SQL, params).first()
+            if row is not None:
+                db.commit()
+                return 0.0
+            tokens = db.execute(self.TOKENS_SQL, params).scalar() or 0
+            db.rollback()
+            return max(0.0, (1 - float(tokens)) / rate)
+        finally:
+            db.close()
+
+backend = PostgresBackend() if config.API_RATE_LIMIT_BACKEND == 'postgres' else MemoryBackend()
+
+def classify(request: Request):
+    """返回请求所属的限流类别，None 表示不限流"""
+    path = request.url.path
+    if not path.startswith('/api/') or path in EXEMPT_ROUTES:
+        return None
+    if request.method == 'POST' and TELEGRAM_ROUTES.match(path):
+        return 'telegram'
+    return 'read'
+
+def client_key(request: Request) -> str:
+    """JWT 中的 user_id；未登录或 Token 无效时使用客户端 IP"""
+    from jose import JWTError, jwt
+    authorization = request.headers.get('authorization', '')
+    if authorization.lower().startswith('bearer '):
+        try:
+            with stage('jwt.decode'):
+                payload = jwt.decode(authorization[7:], config.SECRET_KEY, algorithms=["HS256"])
+            user_id = payload.get("user_id")
+            if user_id is not None:
+                request.state.user_id = user_id
+                user_id_var.set(user_id)
+                return f"user:{user_id}"
+        except JWTError:
+            pass
+
+    forwarded = request.headers.get('x-real-ip') or request.headers.get('x-forwarded-for', '').split(',')[0].strip()
+    return f"ip:{forwarded or (request.client.host if request.client else 'unknown')}"
+
+async def rate_limit_middleware(request: Request, call_next):
+    kind = classify(request)
+    if kind is None:
+        return await call_next(request)
+
+    rate, capacity = LIMITS[kind]
+    key = f"{client_key(request)}:{kind}"
+    if isinstance(backend, PostgresBackend):
+        wait = await run_in_threadpool(backend.consume, key, rate, capacity)
+    else:
+        wait = backend.consume(key, rate, capacity)
+
+    if wait > 0:
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "请求过于频繁，请稍后再试"},
+            headers={"Retry-After": str(max(1, int(wait + 0.999)))},
+        )
+    return await call_next(request)
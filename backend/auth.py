@@ -1,17 +1,20 @@
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from typing import Optional
-from jose import JWTError, jwt
-from passlib.context import CryptContext
 from sqlalchemy.orm import Session
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 import config
-from database import User, get_db
+from database import User, get_db, get_read_db
+from profiling import stage
 import re
 
-# 密码加密上下文
-# 使用 pbkdf2_sha256 替代 bcrypt 以避免 72 字节长度限制问题
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+@lru_cache(maxsize=None)
+def get_pwd_context():
+    """密码加密上下文 (首次使用时才导入 passlib)"""
+    from passlib.context import CryptContext
+    # 使用 pbkdf2_sha256 替代 bcrypt 以避免 72 字节长度限制问题
+    return CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
 
 # OAuth2 方案 (Token 获取地址)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
@@ -21,11 +24,11 @@ EMAIL_REGEX = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
 
 def verify_password(plain_password, hashed_password):
     """验证密码"""
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 def get_password_hash(password):
     """获取密码哈希"""
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
 def validate_email(email: str) -> bool:
     """验证邮箱格式"""
@@ -33,6 +36,7 @@ def validate_email(email: str) -> bool:
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """创建 JWT Token"""
+    from jose import jwt
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.now(timezone.utc) + expires_delta
@@ -43,22 +47,38 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, config.SECRET_KEY, algorithm="HS256")
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    """获取当前用户 (依赖注入)"""
+def _authenticate(token: str, db: Session) -> User:
+    from jose import JWTError, jwt
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, config.SECRET_KEY, algorithms=["HS256"])
+        with stage('jwt.decode'):
+            payload = jwt.decode(token, config.SECRET_KEY, algorithms=["HS256"])
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
         
-    user = db.query(User).filter(User.email == email).first()
+    with stage('user.lookup'):
+        user = db.query(User).filter(User.email == email).first()
     if user is None:
         raise credentials_exception
     return user
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    """获取当前用户 (依赖注入)"""
+    return _authenticate(token, db)
+
+async def get_current_user_readonly(token: str = Depends(oauth2_scheme), db: Session = Depends(get_read_db)):
+    """只读接口获取当前用户 (可能来自只读副本，不能用于修改)"""
+    return _authenticate(token, db)
+
+async def get_admin_user(current_user: User = Depends(get_current_user)):
+    """仅允许 ADMIN_EMAILS 中的用户 (依赖注入)"""
+    if current_user.email.lower() not in config.ADMIN_EMAILS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="需要管理员权限")
+    return current_user
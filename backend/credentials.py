@@ -0,0 +1,238 @@
+"""Telegram API 凭证池
+
+- 每个账号登录时绑定一个凭证 (accounts.api_id)，之后该账号的 Session 始终用这个凭证连接；
+  未绑定的旧账号使用默认凭证 (API_ID/API_HASH)
+- 新账号分配给绑定账号最少的凭证，最近触发过 FloodWait 或被 Telegram 判定无效的凭证暂不分配
+- 每个凭证单独统计并发调用数、调用次数和 FloodWait 次数；限流器也按凭证分别维护 API 令牌桶
+- TG_RATE_LIMIT_BACKEND=postgres 时，各进程 (API、分片 worker) 把凭证状态写入 telegram_credential_stats，
+  分配凭证和 /api/telegram/limits 使用所有进程汇总后的状态
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from sqlalchemy import func, text
+import config
+from database import SessionLocal, Account
+
+logger = logging.getLogger(__name__)
+
+class Credential:
+    def __init__(self, api_id: int, api_hash: str):
+        self.api_id = api_id
+        self.api_hash = api_hash
+        # 正在进行的调用数
+        self.active = 0
+        self.calls = 0
+        self.floods = 0
+        # 最近一次 FloodWait 的截止时间 (monotonic)
+        self.flood_until = 0.0
+        # 被 Telegram 判定无效时的错误信息
+        self.disabled = None
+
+def parse_credentials(value: str):
+    """解析 "api_id:api_hash,api_id:api_hash" 格式的凭证列表"""
+    credentials = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        api_id, _, api_hash = item.partition(':')
+        if not api_hash:
+            raise ValueError(f"API_CREDENTIALS 格式错误: {item} (应为 api_id:api_hash)")
+        credentials.append(Credential(int(api_id), api_hash.strip()))
+    return credentials
+
+class CredentialPool:
+    def __init__(self, credentials):
+        self._lock = threading.Lock()
+        self._credentials = {}
+        for credential in credentials:
+            self._credentials.setdefault(credential.api_id, credential)
+        self.default = credentials[0]
+
+    def get(self, api_id: int = None) -> Credential:
+        """账号绑定的凭证，api_id 为空时返回默认凭证"""
+        if api_id is None:
+            return self.default
+        credential = self._credentials.get(api_id)
+        if credential is None:
+            raise Exception(f"API 凭证 {api_id} 未配置，请检查 API_CREDENTIALS")
+        return credential
+
+    def assign(self, db) -> Credential:
+        """为新账号选择凭证：优先选择未处于 FloodWait 且绑定账号最少的凭证"""
+        counts = dict(db.query(Account.api_id, func.count(Account.id)).group_by(Account.api_id).all())
+        counts[self.default.api_id] = counts.get(self.default.api_id, 0) + counts.pop(None, 0)
+
+        states = {state["api_id"]: state for state in self.snapshot()}
+        candidates = [c for c in self._credentials.values() if states[c.api_id]["disabled"] is None]
+        if not candidates:
+            raise Exception("没有可用的 API 凭证，请检查 API_CREDENTIALS")
+        return min(candidates, key=lambda c: (
+            states[c.api_id]["flood_wait"] > 0, counts.get(c.api_id, 0), states[c.api_id]["active"]
+        ))
+
+    @contextmanager
+    def track(self, api_id: int):
+        """统计一次调用的并发数和调用次数"""
+        credential = self.get(api_id)
+        with self._lock:
+            credential.active += 1
+            credential.calls += 1
+        try:
+            yield credential
+        finally:
+            with self._lock:
+                credential.active -= 1
+
+    def record_flood(self, api_id: int, seconds: float):
+        credential = self.get(api_id)
+        with self._lock:
+            credential.floods += 1
+            credential.flood_until = max(credential.flood_until, time.monotonic() + seconds)
+
+    def disable(self, api_id: int, reason: str):
+        """凭证被 Telegram 拒绝时停止为新账号分配该凭证 (已绑定的账号不受影响)"""
+        credential = self.get(api_id)
+        with self._lock:
+            credential.disabled = reason
+        logger.error(f"❌ API 凭证 {api_id} 已停止分配: {reason}")
+
+    def snapshot(self) -> list:
+        with self._lock:
+            now = time.monotonic()
+            return [{
+                "api_id": c.api_id,
+                "active": c.active,
+                "calls": c.calls,
+                "floods": c.floods,
+                "flood_wait": max(0, int(c.flood_until - now)),
+                "disabled": c.disabled
+            } for c in self._credentials.values()]
+
+class SharedCredentialPool(CredentialPool):
+    """凭证状态写入数据库，由所有进程共享
+
+    - FloodWait 截止时间和停用状态立即写入
+    - 调用计数和并发数由后台线程每 REPORT_INTERVAL 秒上报一次 (同时作为心跳)
+    - 并发数和停用状态只统计仍在上报的进程，调用次数和 FloodWait 次数累计所有进程
+    """
+    REPORT_INTERVAL = 5
+    # 超过该秒数未上报的进程视为已退出
+    STALE_AFTER = 30
+
+    REPORT_SQL = text("""
+        INSERT INTO telegram_credential_stats (process, api_id, active, calls, floods, disabled, updated_at)
+        VALUES (:process, :api_id, :active, :calls, :floods, :disabled, now())
+        ON CONFLICT (process, api_id) DO UPDATE SET
+            active = EXCLUDED.active, calls = EXCLUDED.calls, floods = EXCLUDED.floods,
+            disabled = EXCLUDED.disabled, updated_at = now()
+    """)
+
+    FLOOD_SQL = text("""
+        INSERT INTO telegram_credential_stats (process, api_id, active, calls, floods, flood_until, updated_at)
+        VALUES (:process, :api_id, 0, 0, 0, now() + make_interval(secs => :seconds), now())
+        ON CONFLICT (process, api_id) DO UPDATE SET
+            flood_until = GREATEST(telegram_credential_stats.flood_until, EXCLUDED.flood_until)
+    """)
+
+    STATS_SQL = text("""
+        SELECT api_id,
+            COALESCE(SUM(active) FILTER (WHERE updated_at > now() - make_interval(secs => :stale)), 0),
+            SUM(calls),
+            SUM(floods),
+            EXTRACT(EPOCH FROM MAX(flood_until) - now()),
+            MAX(disabled) FILTER (WHERE updated_at > now() - make_interval(secs => :stale))
+        FROM telegram_credential_stats GROUP BY api_id
+    """)
+
+    PRUNE_SQL = text("DELETE FROM telegram_credential_stats WHERE updated_at < now() - interval '7 days'")
+
+    def __init__(self, credentials):
+        super().__init__(credentials)
+        self.process = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._reporter = None
+
+    @contextmanager
+    def track(self, api_id: int):
+        self._start_reporter()
+        with super().track(api_id) as credential:
+            yield credential
+
+    def record_flood(self, api_id: int, seconds: float):
+        super().record_flood(api_id, seconds)
+        db = SessionLocal()
+        try:
+            db.execute(self.FLOOD_SQL, {"process": self.process, "api_id": api_id, "seconds": float(seconds)})
+            db.commit()
+        finally:
+            db.close()
+
+    def disable(self, api_id: int, reason: str):
+        super().disable(api_id, reason)
+        self.report()
+
+    def _start_reporter(self):
+        if self._reporter is not None:
+            return
+        with self._lock:
+            if self._reporter is None:
+                self._reporter = threading.Thread(target=self._report_loop, name='credential-stats', daemon=True)
+                self._reporter.start()
+
+    def _report_loop(self):
+        while True:
+            time.sleep(self.REPORT_INTERVAL)
+            try:
+                self.report()
+            except Exception as e:
+                logger.warning(f"⚠️ 上报 API 凭证状态失败: {e}")
+
+    def report(self):
+        """将本进程的凭证状态写入数据库"""
+        with self._lock:
+            rows = [{
+                "process": self.process,
+                "api_id": c.api_id,
+                "active": c.active,
+                "calls": c.calls,
+                "floods": c.floods,
+                "disabled": c.disabled
+            } for c in self._credentials.values()]
+        db = SessionLocal()
+        try:
+            for row in rows:
+                db.execute(self.REPORT_SQL, row)
+            db.execute(self.PRUNE_SQL)
+            db.commit()
+        finally:
+            db.close()
+
+    def snapshot(self) -> list:
+        db = SessionLocal()
+        try:
+            stats = {row[0]: row[1:] for row in db.execute(self.STATS_SQL, {"stale": self.STALE_AFTER}).all()}
+            db.rollback()
+        finally:
+            db.close()
+
+        result = []
+        for local in super().snapshot():
+            # 本进程尚未上报的部分以本地状态为准
+            active, calls, floods, flood_wait, disabled = stats.get(local["api_id"], (0, 0, 0, None, None))
+            result.append({
+                "api_id": local["api_id"],
+                "active": max(int(active), local["active"]),
+                "calls": max(int(calls), local["calls"]),
+                "floods": max(int(floods), local["floods"]),
+                "flood_wait": max(int(flood_wait or 0), local["flood_wait"], 0),
+                "disabled": disabled or local["disabled"]
+            })
+        return result
+
+_credentials = [Credential(config.API_ID, config.API_HASH)] + parse_credentials(config.API_CREDENTIALS)
+pool = SharedCredentialPool(_credentials) if config.TG_RATE_LIMIT_BACKEND == 'postgres' else CredentialPool(_credentials)
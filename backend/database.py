@@ -1,16 +1,37 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, ForeignKey
+from sqlalchemy import create_engine, event, text, func, literal_column, Column, Integer, BigInteger, String, DateTime, Boolean, Float, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from fastapi import Depends
 from datetime import datetime, timezone
+import itertools
+import logging
+import threading
+import time
 import config
+from log_config import user_id_var
+
+logger = logging.getLogger(__name__)
 
 engine = create_engine(config.DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# 只读副本 (未配置时所有读写都走主库)
+read_engines = [
+    create_engine(url.strip(), pool_pre_ping=True, execution_options={"postgresql_readonly": True})
+    for url in config.DATABASE_READ_URL.split(',') if url.strip()
+]
+_read_sessions = itertools.cycle([
+    sessionmaker(autocommit=False, autoflush=False, bind=read_engine) for read_engine in read_engines
+])
+
 def utcnow():
     return datetime.now(timezone.utc).replace(tzinfo=None)
 
+def message_tsvector(message_column):
+    """验证码消息的全文检索向量 (查询时必须与索引表达式完全一致才能命中索引)"""
+    return func.to_tsvector(literal_column("'simple'"), func.coalesce(message_column, literal_column("''")))
+
 class User(Base):
     __tablename__ = 'users'
     
@@ -21,7 +42,8 @@ class User(Base):
     is_active = Column(Boolean, default=True)
     
     # 关系
-    accounts = relationship("Account", back_populates="user", cascade="all, delete-orphan")
+    # 删除由数据库外键 ON DELETE CASCADE 完成，ORM 不再逐条加载子记录
+    accounts = relationship("Account", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
 
 class Account(Base):
     __tablename__ = 'accounts'
@@ -30,37 +52,311 @@ class Account(Base):
     phone = Column(String, index=True) # Removed unique=True
     session_name = Column(String, unique=True)
     is_active = Column(Boolean, default=True)
+    # 登录时绑定的 Telegram API 凭证，为空表示默认凭证 (config.API_ID)
+    api_id = Column(Integer, nullable=True, index=True)
     created_at = Column(DateTime, default=utcnow)
     updated_at = Column(DateTime, default=utcnow, onupdate=utcnow)
     
     # 外键
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     
     # 关系
     user = relationship("User", back_populates="accounts")
-    codes = relationship("VerificationCode", back_populates="account", cascade="all, delete-orphan")
+    codes = relationship("VerificationCode", back_populates="account", cascade="all, delete-orphan", passive_deletes=True)
 
 class VerificationCode(Base):
     __tablename__ = 'verification_codes'
     
     id = Column(Integer, primary_key=True, index=True)
-    account_id = Column(Integer, ForeignKey('accounts.id'), index=True)
+    account_id = Column(Integer, ForeignKey('accounts.id', ondelete='CASCADE'), index=True)
     phone = Column(String, index=True)
     code = Column(String)
     message = Column(String)
     service = Column(String, nullable=True)
     received_at = Column(DateTime, default=utcnow, index=True)
+    # 入库时间 (received_at 是消息时间)，增量同步据此判断记录是否已稳定提交
+    created_at = Column(DateTime, default=utcnow)
     
     # 关系
     account = relationship("Account", back_populates="codes")
+    
+    __table_args__ = (
+        # 消息全文检索 (GIN 索引在大表上构建较慢，使用 CONCURRENTLY 不阻塞写入)
+        Index(
+            'ix_verification_codes_message_fts', message_tsvector(message),
+            postgresql_using='gin',
+            postgresql_concurrently=True
+        ),
+        # 验证码前缀/模糊匹配 (需要 pg_trgm 扩展)
+        Index(
+            'ix_verification_codes_code_trgm', code,
+            postgresql_using='gin',
+            postgresql_ops={'code': 'gin_trgm_ops'},
+            postgresql_concurrently=True
+        ),
+    )
+
+class ReceiverJob(Base):
+    """API 下发给 receiver_worker 的任务 (check / keep_alive)"""
+    __tablename__ = 'receiver_jobs'
+    
+    id = Column(Integer, primary_key=True, index=True)
+    account_id = Column(Integer, ForeignKey('accounts.id', ondelete='CASCADE'), nullable=False, index=True)
+    kind = Column(String, nullable=False)
+    status = Column(String, default='pending', index=True)  # pending / running / done / failed
+    result = Column(Integer, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        # 同一账号同类任务最多只有一条排队/执行中的记录，重复请求合并到这条记录上
+        Index(
+            'uq_receiver_jobs_active', 'account_id', 'kind',
+            unique=True,
+            postgresql_where=status.in_(['pending', 'running'])
+        ),
+    )
+
+class ApiRateLimit(Base):
+    """API 限流令牌桶 (多个后端进程共享限流状态时使用)"""
+    __tablename__ = 'api_rate_limits'
+    
+    key = Column(String, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+class UserWrite(Base):
+    """用户最近一次写操作的时间 (多个后端进程共享读写一致性状态时使用)"""
+    __tablename__ = 'user_writes'
+    
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    written_at = Column(DateTime, nullable=False)
+
+class TelegramFloodWait(Base):
+    """账号 FloodWait 暂停截止时间 (多个进程共享 Telegram 限流状态时使用)"""
+    __tablename__ = 'telegram_flood_waits'
+    
+    key = Column(String, primary_key=True)
+    until = Column(DateTime, nullable=False)
+
+class TelegramCredentialStats(Base):
+    """各进程上报的 API 凭证状态 (多个进程共享 Telegram 限流状态时使用)"""
+    __tablename__ = 'telegram_credential_stats'
+    
+    # 主机名:pid:随机后缀，每次启动一行
+    process = Column(String, primary_key=True)
+    api_id = Column(Integer, primary_key=True)
+    active = Column(Integer, nullable=False, default=0)
+    calls = Column(BigInteger, nullable=False, default=0)
+    floods = Column(Integer, nullable=False, default=0)
+    flood_until = Column(DateTime, nullable=True)
+    disabled = Column(String, nullable=True)
+    updated_at = Column(DateTime, nullable=False)
+
+class Webhook(Base):
+    """用户订阅的 Webhook，收到新验证码时推送"""
+    __tablename__ = 'webhooks'
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    url = Column(String, nullable=False)
+    # HMAC-SHA256 签名密钥
+    secret = Column(String, nullable=False)
+    is_active = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=utcnow)
+
+class WebhookDelivery(Base):
+    """待推送的验证码 (与验证码在同一事务中写入)"""
+    __tablename__ = 'webhook_deliveries'
+    
+    id = Column(Integer, primary_key=True, index=True)
+    webhook_id = Column(Integer, ForeignKey('webhooks.id', ondelete='CASCADE'), nullable=False, index=True)
+    # 单条验证码的 JSON
+    payload = Column(String, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    # 下次推送时间；推送进行中时为租约到期时间
+    next_attempt_at = Column(DateTime, default=utcnow, nullable=False, index=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=utcnow)
+
+class WebhookDeadLetter(Base):
+    """重试次数用尽仍未推送成功的验证码"""
+    __tablename__ = 'webhook_dead_letters'
+    
+    id = Column(Integer, primary_key=True, index=True)
+    webhook_id = Column(Integer, ForeignKey('webhooks.id', ondelete='CASCADE'), nullable=False, index=True)
+    payload = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime)
+    failed_at = Column(DateTime, default=utcnow)
 
 def get_db():
     db = SessionLocal()
+    # 只有请求自身的会话计入读写一致性 (限流计数等内部提交不算用户写操作)
+    db.info['user_writes'] = True
     try:
         yield db
     finally:
         db.close()
 
+class MemoryWrites:
+    """进程内记录 user_id -> 最近一次在主库提交的时间 (monotonic)，只对单个后端进程有效"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._writes = {}
+        self._pruned = time.monotonic()
+
+    def mark(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            self._writes[user_id] = now
+            # 定期清理窗口外的记录，避免字典随用户数无限增长
+            if now - self._pruned > config.READ_YOUR_WRITES_WINDOW:
+                cutoff = now - config.READ_YOUR_WRITES_WINDOW
+                self._writes = {uid: written for uid, written in self._writes.items() if written >= cutoff}
+                self._pruned = now
+
+    def recent(self, user_id) -> bool:
+        written = self._writes.get(user_id)
+        return written is not None and time.monotonic() - written < config.READ_YOUR_WRITES_WINDOW
+
+class PostgresWrites:
+    """写操作时间记录在主库 user_writes 表 (每个用户一行)，所有后端进程共享"""
+
+    MARK_SQL = text("""
+        INSERT INTO user_writes (user_id, written_at) VALUES (:user_id, now())
+        ON CONFLICT (user_id) DO UPDATE SET written_at = now()
+    """)
+
+    RECENT_SQL = text("""
+        SELECT 1 FROM user_writes
+        WHERE user_id = :user_id AND written_at > now() - make_interval(secs => :window)
+    """)
+
+    def mark(self, user_id):
+        # 新会话没有 user_writes 标记，提交时不会再次触发 mark_write
+        db = SessionLocal()
+        try:
+            db.execute(self.MARK_SQL, {"user_id": user_id})
+            db.commit()
+        finally:
+            db.close()
+
+    def recent(self, user_id) -> bool:
+        with engine.connect() as conn:
+            return conn.execute(self.RECENT_SQL, {
+                "user_id": user_id, "window": config.READ_YOUR_WRITES_WINDOW
+            }).first() is not None
+
+_writes = PostgresWrites() if config.READ_YOUR_WRITES_BACKEND == 'postgres' else MemoryWrites()
+
+def mark_write(user_id):
+    """记录用户的写操作，READ_YOUR_WRITES_WINDOW 秒内该用户的读请求走主库"""
+    if user_id is not None and read_engines:
+        _writes.mark(user_id)
+
+def wrote_recently(user_id) -> bool:
+    if user_id is None:
+        return False
+    return _writes.recent(user_id)
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _after_commit(session):
+    # 请求会话的提交记为当前用户的写操作；请求触发的其他会话 (如检查任务入库) 由调用方显式 mark_write
+    if session.info.get('user_writes'):
+        mark_write(user_id_var.get())
+
+def get_read_db(db=Depends(get_db)):
+    """只读接口使用的会话
+
+    配置了 DATABASE_READ_URL 且当前用户最近没有写操作时使用只读副本，
+    否则直接复用 get_db 的主库会话。
+    """
+    if not read_engines or wrote_recently(user_id_var.get()):
+        yield db
+        return
+    read_db = next(_read_sessions)()
+    try:
+        yield read_db
+    finally:
+        read_db.close()
+
+# 需要 ON DELETE CASCADE 的外键: (表, 列, 引用表)
+CASCADE_FOREIGN_KEYS = [
+    ('accounts', 'user_id', 'users'),
+    ('verification_codes', 'account_id', 'accounts'),
+]
+
+def migrate_cascade_foreign_keys(conn):
+    """旧版本创建的外键没有 ON DELETE CASCADE，替换为级联外键"""
+    for table, column, ref_table in CASCADE_FOREIGN_KEYS:
+        rows = conn.execute(text("""
+            SELECT con.conname, con.confdeltype FROM pg_constraint con
+            JOIN pg_class rel ON rel.oid = con.conrelid
+            JOIN pg_attribute att ON att.attrelid = con.conrelid AND att.attnum = ANY(con.conkey)
+            WHERE con.contype = 'f' AND rel.relname = :table AND att.attname = :column
+        """), {"table": table, "column": column}).all()
+        
+        stale = [name for name, delete_type in rows if delete_type != 'c']
+        if not stale and rows:
+            continue
+        for name in stale:
+            conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'))
+        conn.execute(text(
+            f"ALTER TABLE {table} ADD CONSTRAINT {table}_{column}_fkey "
+            f"FOREIGN KEY ({column}) REFERENCES {ref_table}(id) ON DELETE CASCADE"
+        ))
+        logger.info(f"✅ 外键 {table}.{column} 已改为 ON DELETE CASCADE")
+
+# 旧版本数据库中缺少的列: (表, 列, 类型)
+ADDED_COLUMNS = [
+    ('accounts', 'api_id', 'INTEGER'),
+    ('verification_codes', 'created_at', 'TIMESTAMP'),
+]
+
+def migrate_columns(conn):
+    """create_all 不会给已存在的表添加新列，这里补齐"""
+    for table, column, column_type in ADDED_COLUMNS:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {column_type}"))
+
+def ensure_indexes(conn):
+    """create_all 不会给已存在的表补建新索引，这里逐个检查并创建
+
+    conn 必须是自动提交连接：CREATE INDEX CONCURRENTLY 不能在事务中执行。
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.dialect_options['postgresql']['concurrently']:
+                drop_invalid_index(conn, index.name)
+            index.create(bind=conn, checkfirst=True)
+
+def drop_invalid_index(conn, name: str):
+    """CONCURRENTLY 构建中断时会留下无效索引，checkfirst 会把它当作已存在，这里先删除"""
+    invalid = conn.execute(text("""
+        SELECT 1 FROM pg_index idx
+        JOIN pg_class cls ON cls.oid = idx.indexrelid
+        WHERE cls.relname = :name AND NOT idx.indisvalid
+    """), {"name": name}).first()
+    if invalid:
+        conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+        logger.warning(f"⚠️ 删除构建失败的索引 {name}，重新创建")
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
-    print("✅ 数据库初始化完成")
+    if engine.dialect.name == 'postgresql':
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        # 部分索引使用 CREATE INDEX CONCURRENTLY，不能放在事务中
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            Base.metadata.create_all(bind=conn)
+        with engine.begin() as conn:
+            migrate_cascade_foreign_keys(conn)
+            migrate_columns(conn)
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            ensure_indexes(conn)
+    else:
+        Base.metadata.create_all(bind=engine)
+    logger.info("✅ 数据库初始化完成")
@@ -0,0 +1,302 @@
+"""Receiver 任务队列
+
+所有账号检查/保活任务都通过 run_job() 执行：
+- 同一账号的同类任务在进程内合并为一次执行，所有等待者共享结果
+- 同一账号的不同任务依次执行，不会有两个 TelegramClient 同时打开同一个 Session 文件
+- RECEIVER_SHARDS > 0 时，任务写入 receiver_jobs 表交给 receiver_worker 执行，
+  并通过 Postgres NOTIFY 唤醒正在等待的 worker
+- 删除账号时通过 NOTIFY 通知 receiver_worker 立即断开该账号的长连接
+- JOB_QUEUE_PERSIST=true 时，本地执行的任务同样写入 receiver_jobs，重启后自动恢复
+"""
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from sqlalchemy import text, case
+from sqlalchemy.exc import IntegrityError
+import config
+from database import SessionLocal, Account, ReceiverJob, utcnow
+from ratelimit import AccountParked
+
+logger = logging.getLogger(__name__)
+
+# LISTEN/NOTIFY 通道名
+JOB_CHANNEL = 'receiver_jobs'
+# 账号删除通知 (payload 为逗号分隔的账号 ID)
+ACCOUNT_CHANNEL = 'receiver_accounts'
+# 每条通知最多包含的账号数 (NOTIFY payload 上限 8000 字节)
+_NOTIFY_BATCH = 500
+
+# (account_id, kind) -> 正在执行的 Future
+_inflight = {}
+
+# account_id -> [asyncio.Lock, 使用者数量]
+_account_locks = {}
+
+# Worker 将 FloodWait 写入任务错误信息时使用的前缀
+_PARKED_PREFIX = 'FLOOD_WAIT:'
+
+# 执行中的任务超过 RECEIVER_JOB_TIMEOUT 仍未结束时记录的错误信息
+_STALE_ERROR = '任务执行中断 (超时未完成)'
+
+def shard_of(account_id: int, total: int) -> int:
+    """根据账号 ID 计算所属分片 (确定性映射)"""
+    return account_id % total
+
+def _active_job(db, account_id: int, kind: str):
+    return db.query(ReceiverJob).filter(
+        ReceiverJob.account_id == account_id,
+        ReceiverJob.kind == kind,
+        ReceiverJob.status.in_(['pending', 'running'])
+    ).first()
+
+def _stale_cutoff():
+    """running 任务的租约: started_at 早于该时间的任务视为执行中断 (worker 重启或崩溃)"""
+    return utcnow() - timedelta(seconds=config.RECEIVER_JOB_TIMEOUT)
+
+def expire_stale_jobs(db) -> int:
+    """将租约过期的 running 任务标记为失败，释放唯一索引，返回数量"""
+    count = db.query(ReceiverJob).filter(
+        ReceiverJob.status == 'running',
+        ReceiverJob.started_at < _stale_cutoff()
+    ).update({
+        ReceiverJob.status: 'failed',
+        ReceiverJob.error: _STALE_ERROR,
+        ReceiverJob.finished_at: utcnow()
+    }, synchronize_session=False)
+    db.commit()
+    if count:
+        logger.warning(f"⚠️ {count} 个任务执行中断，已标记为失败")
+    return count
+
+def enqueue_job(db, account_id: int, kind: str, notify: bool = True) -> ReceiverJob:
+    """写入一条待执行任务；已有排队/执行中的同类任务时直接返回该任务"""
+    existing = _active_job(db, account_id, kind)
+    if existing and existing.status == 'running' and existing.started_at < _stale_cutoff():
+        # 执行该任务的进程已退出，放弃它并重新排队
+        expire_stale_jobs(db)
+        existing = _active_job(db, account_id, kind)
+    if existing:
+        return existing
+
+    job = ReceiverJob(account_id=account_id, kind=kind, status='pending')
+    db.add(job)
+    try:
+        db.flush()
+    except IntegrityError:
+        # 并发写入被唯一索引拦截，合并到已存在的任务
+        db.rollback()
+        return _active_job(db, account_id, kind)
+
+    if notify:
+        # NOTIFY 在事务提交时才会送达
+        db.execute(text("SELECT pg_notify(:channel, :payload)"), {
+            "channel": JOB_CHANNEL,
+            "payload": str(account_id)
+        })
+    db.commit()
+    db.refresh(job)
+    return job
+
+def notify_accounts_removed(db, account_ids):
+    """通知 receiver_worker 断开已删除账号的连接 (与删除在同一事务中，提交时才送达)"""
+    if config.RECEIVER_SHARDS <= 0:
+        return
+    account_ids = list(account_ids)
+    for start in range(0, len(account_ids), _NOTIFY_BATCH):
+        db.execute(text("SELECT pg_notify(:channel, :payload)"), {
+            "channel": ACCOUNT_CHANNEL,
+            "payload": ",".join(str(account_id) for account_id in account_ids[start:start + _NOTIFY_BATCH])
+        })
+
+def claim_jobs(db, shard_index: int, shard_total: int, limit: int = 1, busy_accounts=()):
+    """认领分片内账号的待执行任务 (多个 worker 并发认领互不冲突)
+
+    认领即开始执行，started_at 是租约的起点；调用方只应认领马上能执行的数量，
+    否则排在后面的任务可能在开始前就被 expire_stale_jobs 判定为中断。
+    手动检查优先于保活任务；busy_accounts 中的账号和同一账号的第二个任务本轮不认领。
+    """
+    # 分片条件与 shard_of 一致，直接在 SQL 中过滤，不随账号总数增长
+    query = db.query(ReceiverJob).filter(
+        ReceiverJob.status == 'pending',
+        ReceiverJob.account_id % shard_total == shard_index
+    )
+    if busy_accounts:
+        query = query.filter(ReceiverJob.account_id.notin_(list(busy_accounts)))
+    candidates = query.order_by(
+        case((ReceiverJob.kind == 'check', 0), else_=1),
+        ReceiverJob.id
+    ).with_for_update(skip_locked=True).limit(limit).all()
+
+    jobs = []
+    accounts = set()
+    for job in candidates:
+        if job.account_id in accounts:
+            continue
+        accounts.add(job.account_id)
+        job.status = 'running'
+        job.started_at = utcnow()
+        jobs.append(job)
+    db.commit()
+    return jobs
+
+def encode_parked(e: AccountParked) -> str:
+    """将 AccountParked 编码为任务错误信息，便于 API 端还原"""
+    return f"{_PARKED_PREFIX}{e.key}:{e.seconds}"
+
+def finish_job(db, job_id: int, result: int = None, error: str = None):
+    """记录任务执行结果"""
+    job = db.query(ReceiverJob).filter(ReceiverJob.id == job_id).first()
+    if not job:
+        return
+    if job.status != 'running':
+        # 租约已过期并被标记为失败 (可能已有新任务排队)，不再覆盖
+        logger.warning(f"⚠️ 任务 {job_id} 已超时被放弃，忽略执行结果")
+        return
+    job.status = 'failed' if error else 'done'
+    job.result = result
+    job.error = error
+    job.finished_at = utcnow()
+    db.commit()
+
+async def wait_for_job(job_id: int, timeout: float = None) -> ReceiverJob:
+    """轮询等待任务完成，超时抛出 TimeoutError"""
+    timeout = timeout or config.RECEIVER_JOB_TIMEOUT
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    while True:
+        db = SessionLocal()
+        try:
+            job = db.query(ReceiverJob).filter(ReceiverJob.id == job_id).first()
+            if job is None or job.status in ('done', 'failed'):
+                return job
+        finally:
+            db.close()
+
+        if loop.time() >= deadline:
+            raise TimeoutError(f"任务 {job_id} 执行超时")
+        await asyncio.sleep(0.5)
+
+async def run_remote(account_id: int, kind: str) -> int:
+    """下发任务给 receiver_worker 并等待结果"""
+    db = SessionLocal()
+    try:
+        job_id = enqueue_job(db, account_id, kind).id
+    finally:
+        db.close()
+
+    job = await wait_for_job(job_id)
+    if job is None:
+        raise Exception("任务已被删除")
+    if job.status == 'failed':
+        if job.error and job.error.startswith(_PARKED_PREFIX):
+            key, seconds = job.error[len(_PARKED_PREFIX):].rsplit(':', 1)
+            raise AccountParked(key, int(seconds))
+        raise Exception(job.error)
+    return job.result
+
+async def run_local(account_id: int, kind: str) -> int:
+    """在当前进程内执行任务"""
+    db = SessionLocal()
+    try:
+        account = db.query(Account).filter(Account.id == account_id).first()
+    finally:
+        db.close()
+    if not account:
+        raise Exception("账号不存在")
+
+    import receiver
+    if kind == 'check':
+        return await receiver.check_codes_for_account(account.phone, account.session_name, account_id=account.id, api_id=account.api_id)
+    if kind == 'keep_alive':
+        await receiver.keep_alive_account(account.phone, account.session_name, account.id, account.api_id)
+        return 0
+    raise ValueError(f"未知任务类型: {kind}")
+
+async def run_local_persisted(account_id: int, kind: str) -> int:
+    """在当前进程内执行任务，并将执行状态记录到 receiver_jobs"""
+    db = SessionLocal()
+    try:
+        job = enqueue_job(db, account_id, kind, notify=False)
+        job.status = 'running'
+        job.started_at = utcnow()
+        db.commit()
+        job_id = job.id
+    finally:
+        db.close()
+
+    result, error = None, None
+    try:
+        result = await run_local(account_id, kind)
+        return result
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        db = SessionLocal()
+        try:
+            finish_job(db, job_id, result=result, error=error)
+        finally:
+            db.close()
+
+@asynccontextmanager
+async def account_lock(account_id: int):
+    """同一账号的任务串行执行 (Session 是 SQLite 文件，并发打开会出现 database is locked)"""
+    entry = _account_locks.get(account_id)
+    if entry is None:
+        entry = _account_locks[account_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _account_locks[account_id]
+
+async def _execute(account_id: int, kind: str):
+    if config.RECEIVER_SHARDS > 0:
+        # 由 receiver_worker 按账号串行执行
+        return await run_remote(account_id, kind)
+    async with account_lock(account_id):
+        if config.JOB_QUEUE_PERSIST:
+            return await run_local_persisted(account_id, kind)
+        return await run_local(account_id, kind)
+
+async def run_job(account_id: int, kind: str) -> int:
+    """执行任务，同一账号的同类任务并发请求只执行一次并共享结果"""
+    key = (account_id, kind)
+    future = _inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_execute(account_id, kind))
+        _inflight[key] = future
+
+        def _cleanup(done):
+            if _inflight.get(key) is done:
+                del _inflight[key]
+
+        future.add_done_callback(_cleanup)
+
+    # shield: 某个等待者断开连接被取消时，不影响其他等待者共享的执行
+    return await asyncio.shield(future)
+
+async def resume_pending_jobs():
+    """启动时恢复上次未执行完的本地任务 (仅 JOB_QUEUE_PERSIST 模式)"""
+    db = SessionLocal()
+    try:
+        pending = [
+            (job.account_id, job.kind) for job in db.query(ReceiverJob).filter(
+                ReceiverJob.status.in_(['pending', 'running'])
+            ).order_by(ReceiverJob.id).all()
+        ]
+    finally:
+        db.close()
+
+    if pending:
+        logger.info(f"🔄 恢复 {len(pending)} 个未完成的任务")
+    for account_id, kind in pending:
+        try:
+            await run_job(account_id, kind)
+        except Exception as e:
+            logger.error(f"❌ 恢复任务失败 (账号 {account_id}, {kind}): {e}", extra={"account_id": account_id})
@@ -0,0 +1,128 @@
+"""统一日志配置
+
+- 业务代码只向内存队列写入日志记录 (QueueHandler)，格式化和 I/O 由后台线程 (QueueListener) 完成，
+  不会阻塞事件循环
+- 控制台输出默认为文本格式，LOG_FORMAT=json 时输出 JSON
+- 文件输出始终为 JSON，按大小轮转，写入 logs/ 目录
+- 请求 ID、用户 ID 通过 contextvars 自动附加到同一请求内的所有日志
+- LOG_LEVELS 可单独设置模块级别，例如 "receiver=DEBUG,apscheduler=WARNING"
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from contextvars import ContextVar
+from datetime import datetime, timezone
+import config
+
+request_id_var = ContextVar('request_id', default=None)
+user_id_var = ContextVar('user_id', default=None)
+
+# 通过 extra={...} 传入时会写入结构化日志的字段
+EXTRA_FIELDS = ('account_id', 'user_id', 'phone', 'job_id', 'duration_ms', 'method', 'path', 'status')
+
+# 默认调低的第三方模块日志级别 (可被 LOG_LEVELS 覆盖)
+DEFAULT_LEVELS = {'httpx': 'WARNING'}
+
+_listener = None
+
+class ContextFilter(logging.Filter):
+    """在记录产生时 (而不是在后台线程中) 读取上下文变量"""
+    def filter(self, record):
+        if getattr(record, 'request_id', None) is None:
+            record.request_id = request_id_var.get()
+        if getattr(record, 'user_id', None) is None:
+            record.user_id = user_id_var.get()
+        return True
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """默认的 prepare() 为了可序列化会把异常堆栈拼进 msg 并清空 exc_info；
+    这里的队列只在进程内使用，保留 exc_info，由后台线程中的各个 formatter 格式化堆栈"""
+    def prepare(self, record):
+        record = copy.copy(record)
+        # 参数可能在之后被修改，消息仍在产生日志的线程中拼好
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.request_id:
+            data["request_id"] = record.request_id
+        for field in EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+def _parse_levels(value: str) -> dict:
+    levels = {}
+    for item in value.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+def setup_logging(name: str = 'backend'):
+    """初始化日志 (重复调用无副作用)，name 决定日志文件名"""
+    global _listener
+    if _listener is not None:
+        return
+
+    if config.LOG_FORMAT == 'json':
+        console_formatter = JsonFormatter()
+    else:
+        console_formatter = logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'
+        )
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(console_formatter)
+    handlers = [console]
+
+    try:
+        os.makedirs(config.LOG_DIR, exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            os.path.join(config.LOG_DIR, f"{name}.log"),
+            maxBytes=config.LOG_MAX_BYTES,
+            backupCount=config.LOG_BACKUP_COUNT,
+            encoding='utf-8'
+        )
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+    except OSError as e:
+        print(f"⚠️ 无法写入日志文件，仅输出到控制台: {e}")
+
+    log_queue = queue.Queue(-1)
+    queue_handler = LocalQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(config.LOG_LEVEL)
+    for logger_name, level in {**DEFAULT_LEVELS, **_parse_levels(config.LOG_LEVELS)}.items():
+        logging.getLogger(logger_name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(flush_logging)
+
+def flush_logging():
+    """停止后台线程并输出队列中剩余的日志"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,29 +1,50 @@
-from fastapi import FastAPI, HTTPException, Depends, Request, status
+import time
+_import_started = time.perf_counter()
+from fastapi import FastAPI, HTTPException, Depends, Request, BackgroundTasks, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import text, func, or_, literal_column
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta, timezone
 from pydantic import BaseModel
 from typing import Optional
+from contextlib import contextmanager
+import glob
+import json
+import os
+import re
+import secrets
+import signal
+import uuid
 import database
-from database import get_db, Account, VerificationCode, User
-import scheduler
-import receiver
+from database import get_db, get_read_db, Account, VerificationCode, User, Webhook, WebhookDelivery, WebhookDeadLetter, message_tsvector
+import config
 import logging
-import sys
+import asyncio
 import auth
-from auth import get_current_user
-
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+from auth import get_current_user, get_current_user_readonly, get_admin_user
+from ratelimit import limiter, AccountParked
+from credentials import pool
+import api_ratelimit
+import profiling
+from log_config import setup_logging, request_id_var
+
+# 配置日志 (后台线程负责输出，不阻塞事件循环)
+setup_logging()
 logger = logging.getLogger(__name__)
 
+# telethon / apscheduler 等重量级模块在首次使用时才导入 (receiver, jobs, scheduler)
+_import_seconds = time.perf_counter() - _import_started
+
+# 就绪状态 (/api/ready)
+_readiness = {
+    "schema": False,
+    "scheduler": False,
+    "telegram": not config.WARMUP_TELEGRAM,
+}
+
 app = FastAPI(title="Telegram 接码平台")
 
 # 捕获验证错误
@@ -41,6 +62,42 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
         content={"detail": exc.errors()},
     )
 
+# Telegram FloodWait: 账号被暂停期间返回 429
+@app.exception_handler(AccountParked)
+async def account_parked_handler(request: Request, exc: AccountParked):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.seconds)},
+    )
+
+# 按用户限流 (放在 CORS 之内，429 响应同样带 CORS 头)
+app.middleware("http")(api_ratelimit.rate_limit_middleware)
+
+# 请求日志: 为每个请求分配 request_id，并记录耗时
+@app.middleware("http")
+async def request_log_middleware(request: Request, call_next):
+    request_id = request.headers.get('x-request-id') or uuid.uuid4().hex[:16]
+    request_id_var.set(request_id)
+    started = time.perf_counter()
+    # 性能分析开启时记录阶段耗时，慢请求输出采样
+    trace = profiling.begin(f"{request.method} {request.url.path}")
+    try:
+        response = await call_next(request)
+    finally:
+        if trace is not None and profiling.end(trace):
+            await run_in_threadpool(profiling.report, trace)
+    response.headers['X-Request-ID'] = request_id
+    if request.url.path != '/api/health':
+        logger.info(f"{request.method} {request.url.path} {response.status_code}", extra={
+            "method": request.method,
+            "path": request.url.path,
+            "status": response.status_code,
+            "user_id": getattr(request.state, 'user_id', None),
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1)
+        })
+    return response
+
 # CORS 配置
 app.add_middleware(
     CORSMiddleware,
@@ -71,6 +128,13 @@ class PasswordChangeRequest(BaseModel):
     old_password: str
     new_password: str
 
+class WebhookRequest(BaseModel):
+    url: str
+
+class ProfileRequest(BaseModel):
+    seconds: int = 30
+    threshold_ms: Optional[int] = None
+
 # --- 认证 API ---
 
 @app.post("/api/auth/register")
@@ -93,6 +157,8 @@ async def register(req: RegisterRequest, db: Session = Depends(get_db)):
     db.add(new_user)
     db.commit()
     db.refresh(new_user)
+    # 注册请求还没有 user_id，手动记录，避免登录后立即读取时副本尚未同步
+    database.mark_write(new_user.id)
     
     return {"message": "注册成功", "user_id": new_user.id}
 
@@ -120,7 +186,7 @@ async def login(req: LoginRequest, db: Session = Depends(get_db)):
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/api/auth/me")
-async def get_me(current_user: User = Depends(get_current_user)):
+async def get_me(current_user: User = Depends(get_current_user_readonly)):
     return {
         "id": current_user.id,
         "email": current_user.email,
@@ -143,41 +209,136 @@ async def change_password(
 
 @app.delete("/api/auth/me")
 async def delete_my_account(
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    # 删除用户的所有 Session 文件
-    import os
-    import glob
+    import jobs
+    user_id = current_user.id
+    accounts = db.query(Account.id, Account.session_name).filter(Account.user_id == user_id).all()
+    session_names = [account.session_name for account in accounts]
     
-    # 查找该用户的所有 session 文件
-    session_files = glob.glob(f"sessions/user_{current_user.id}_*.session")
-    for f in session_files:
-        try:
-            os.remove(f)
-        except Exception as e:
-            logger.error(f"删除 Session 文件失败: {f}, {e}")
-            
-    # 删除数据库记录 (级联删除 accounts 和 codes)
-    db.delete(current_user)
+    # 删除数据库记录 (由外键 ON DELETE CASCADE 级联删除 accounts 和 codes)
+    db.query(User).filter(User.id == user_id).delete(synchronize_session=False)
+    # Worker 模式下通知 receiver_worker 断开这些账号
+    jobs.notify_accounts_removed(db, [account.id for account in accounts])
     db.commit()
+    
+    # 删除用户的所有 Session 文件 (响应返回后在后台执行)
+    background_tasks.add_task(_remove_session_files, session_names, f"user_{user_id}_*.session")
     return {"message": "账号已注销"}
 
+def _remove_session_files(session_names, pattern: str = None):
+    """删除 Session 文件 (在后台任务中执行)"""
+    paths = {os.path.join(config.SESSION_DIR, f"{name}.session") for name in session_names if name}
+    if pattern:
+        paths.update(glob.glob(os.path.join(config.SESSION_DIR, pattern)))
+    
+    for path in paths:
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+                logger.info(f"✅ Session 文件已删除: {path}")
+        except Exception as e:
+            logger.error(f"删除 Session 文件失败: {path}, {e}")
+
+@contextmanager
+def _startup_phase(name: str):
+    """记录启动阶段耗时"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        logger.info(f"⏱️ 启动阶段 [{name}] 耗时 {(time.perf_counter() - started) * 1000:.0f}ms")
+
+def _warm_up_telegram():
+    """预加载 Telethon 相关模块，避免首个 Telegram 请求承担导入开销"""
+    import receiver
+    import jobs
+
+# 启动阶段失败后的最大重试间隔 (秒)
+STARTUP_RETRY_MAX_DELAY = 60
+
+async def _retry_phase(name: str, func):
+    """执行启动阶段，失败时按指数退避重试直到成功 (数据库短暂不可用等情况)"""
+    delay = 1
+    while True:
+        try:
+            with _startup_phase(name):
+                return await run_in_threadpool(func)
+        except Exception as e:
+            logger.error(f"❌ 启动阶段 [{name}] 失败，{delay} 秒后重试: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, STARTUP_RETRY_MAX_DELAY)
+
+async def _background_startup():
+    """数据库初始化、调度器启动等耗时操作在后台完成，不阻塞服务启动"""
+    try:
+        await _retry_phase("数据库初始化", database.init_db)
+        _readiness["schema"] = True
+
+        import scheduler
+        loop = asyncio.get_running_loop()
+        await _retry_phase("调度器启动", lambda: scheduler.start_scheduler(loop))
+        _readiness["scheduler"] = True
+
+        if config.JOB_QUEUE_PERSIST and config.RECEIVER_SHARDS == 0:
+            import jobs
+            asyncio.create_task(jobs.resume_pending_jobs())
+
+        if config.WEBHOOK_DELIVERY:
+            import webhooks
+            asyncio.create_task(webhooks.run_delivery_loop())
+
+        if config.WARMUP_TELEGRAM:
+            with _startup_phase("Telegram 预热"):
+                await run_in_threadpool(_warm_up_telegram)
+            _readiness["telegram"] = True
+    except Exception as e:
+        # 无法重试的错误: 退出进程，由容器 (restart: always) 重新启动
+        logger.exception(f"❌ 后台启动任务失败，服务即将退出: {e}")
+        os.kill(os.getpid(), signal.SIGTERM)
+
 @app.on_event("startup")
 async def startup_event():
-    """启动时初始化数据库和调度器"""
-    database.init_db()
-    scheduler.start_scheduler()
+    """启动时在后台初始化数据库和调度器"""
+    logger.info(f"⏱️ 启动阶段 [模块加载] 耗时 {_import_seconds * 1000:.0f}ms")
+    asyncio.create_task(_background_startup())
 
 @app.get("/api/health")
 async def health_check():
-    """健康检查"""
+    """存活检查 (进程可以响应请求即可)"""
     return {"status": "ok", "timestamp": datetime.now(timezone.utc).isoformat()}
 
+def _ping_db() -> bool:
+    db = database.SessionLocal()
+    try:
+        db.execute(text("SELECT 1"))
+        return True
+    except Exception:
+        return False
+    finally:
+        db.close()
+
+@app.get("/api/ready")
+async def readiness_check():
+    """就绪检查 (数据库可用、表结构已初始化、调度器已启动、Telegram 预热完成)"""
+    checks = dict(_readiness)
+    checks["database"] = await run_in_threadpool(_ping_db)
+    if _readiness["scheduler"]:
+        import scheduler
+        checks["scheduler"] = scheduler.scheduler.running
+
+    ready = all(checks.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "not_ready", "checks": checks},
+    )
+
 @app.get("/api/accounts")
 async def get_accounts(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_user_readonly)
 ):
     """获取当前用户的所有账号"""
     accounts = db.query(Account).filter(Account.user_id == current_user.id).all()
@@ -205,9 +366,10 @@ async def send_code(
             raise HTTPException(status_code=400, detail="已存在该账号")
         
         # 发送验证码
+        import receiver
         await receiver.send_verification_code(request.phone)
         return {"status": "ok", "message": "验证码已发送"}
-    except HTTPException:
+    except (HTTPException, AccountParked):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -233,7 +395,8 @@ async def verify_and_login(
         target_session_name = f"user_{current_user.id}_{clean_phone}"
 
         # 执行登录
-        session_name = await receiver.verify_and_create_session(
+        import receiver
+        session_name, api_id = await receiver.verify_and_create_session(
             request.phone, 
             request.code, 
             request.password,
@@ -243,6 +406,7 @@ async def verify_and_login(
         if existing:
             # 更新现有账号
             existing.session_name = session_name
+            existing.api_id = api_id
             existing.is_active = True
             # existing.created_at = datetime.now(timezone.utc) # 保持原创建时间
             db.commit()
@@ -253,6 +417,7 @@ async def verify_and_login(
             new_account = Account(
                 phone=request.phone,
                 session_name=session_name,
+                api_id=api_id,
                 is_active=True,
                 user_id=current_user.id
             )
@@ -270,7 +435,7 @@ async def verify_and_login(
                 "created_at": account_data.created_at.isoformat()
             }
         }
-    except HTTPException:
+    except (HTTPException, AccountParked):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -278,24 +443,28 @@ async def verify_and_login(
 @app.delete("/api/accounts/{account_id}")
 async def delete_account(
     account_id: int, 
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
     """删除账号"""
-    account = db.query(Account).filter(
+    account = db.query(Account.session_name).filter(
         Account.id == account_id,
         Account.user_id == current_user.id
     ).first()
     if not account:
         raise HTTPException(status_code=404, detail="账号不存在")
     
-    # 删除 session 文件
-    await receiver.delete_session(account.session_name)
-    
-    # 从数据库删除
-    db.delete(account)
+    # 从数据库删除 (验证码由外键级联删除)
+    import jobs
+    db.query(Account).filter(Account.id == account_id).delete(synchronize_session=False)
+    # Worker 模式下通知 receiver_worker 断开该账号
+    jobs.notify_accounts_removed(db, [account_id])
     db.commit()
     
+    # 删除 session 文件
+    background_tasks.add_task(_remove_session_files, [account.session_name])
+    
     return {"status": "ok", "message": "账号已删除"}
 
 @app.post("/api/accounts/check/{account_id}")
@@ -315,11 +484,11 @@ async def check_account_codes(
         raise HTTPException(status_code=404, detail="账号不存在")
     
     try:
-        count = await receiver.check_codes_for_account(
-            account.phone, 
-            account.session_name,
-            account_id=account.id
-        )
+        # 同一账号的并发检查请求合并为一次执行 (Worker 模式下由 receiver_worker 执行)
+        import jobs
+        count = await jobs.run_job(account.id, 'check')
+        # 新验证码可能由 receiver_worker 写入，检查完成后的读取走主库
+        database.mark_write(current_user.id)
         
         if count == -1:
             # Session 失效，更新数据库状态
@@ -336,21 +505,46 @@ async def check_account_codes(
         else:
             # 虽然成功执行了检查，但没有新验证码，返回特定消息供前端判断
             return {"status": "ok", "message": "未发现验证码（检查了最近30分钟消息）"}
-    except HTTPException:
+    except (HTTPException, AccountParked):
         raise
+    except TimeoutError:
+        raise HTTPException(status_code=504, detail="检查超时，任务仍在排队或执行中，请稍后查看验证码")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"检查失败: {str(e)}")
 
+@app.get("/api/telegram/limits")
+async def get_telegram_limits(
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_user_readonly)
+):
+    """查看 Telegram 限流状态 (账号部分仅返回当前用户的账号)"""
+    phones = {phone for (phone,) in db.query(Account.phone).filter(Account.user_id == current_user.id).all()}
+    return {**limiter.snapshot(keys=phones), "credentials": pool.snapshot()}
+
 @app.get("/api/codes")
 async def get_codes(
     phone: Optional[str] = None,
     account_id: Optional[int] = None,
     hours: int = 24,
     limit: int = 100,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    since_id: Optional[int] = None,
+    per_account: Optional[int] = None,
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_user_readonly)
 ):
-    """获取验证码列表"""
+    """获取验证码列表
+
+    传入 since_id 时为增量同步模式，返回:
+    - codes: id 大于 since_id 的新记录 (按 id 升序，最多 limit 条)
+    - cursor: 下次请求使用的 since_id (不越过刚写入的记录，这些记录下次可能重复返回)；
+      has_more 为 true 时应立即继续拉取
+    - min_ids: 各账号当前仍保留的最小记录 id，本地缓存中更小的 id 已被删除；
+      不在 min_ids 中的账号已没有任何记录
+    limit=0 时只返回当前同步位置。
+
+    传入 per_account 时返回每个账号最近的 per_account 条记录 (忽略 limit)，
+    前端首次加载时用一次请求拿到所有账号的消息。
+    """
     time_threshold = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=hours)
     
     query = db.query(VerificationCode).join(
@@ -364,11 +558,25 @@ async def get_codes(
         query = query.filter(Account.id == account_id)
     elif phone:
         query = query.filter(Account.phone == phone)
-        
-    codes = query.order_by(VerificationCode.received_at.desc()).limit(limit).all()
+    
+    if since_id is not None:
+        return _codes_delta(query, since_id, limit)
+
+    if per_account:
+        rank = func.row_number().over(
+            partition_by=VerificationCode.account_id,
+            order_by=VerificationCode.received_at.desc()
+        ).label('rank')
+        ranked = query.with_entities(VerificationCode.id.label('id'), rank).subquery()
+        codes = db.query(VerificationCode).join(ranked, VerificationCode.id == ranked.c.id).filter(
+            ranked.c.rank <= per_account
+        ).order_by(VerificationCode.account_id, VerificationCode.received_at.desc()).all()
+    else:
+        codes = query.order_by(VerificationCode.received_at.desc()).limit(limit).all()
     
     return [{
         "id": code.id,
+        "account_id": code.account_id,
         "phone": code.phone,
         "code": code.code,
         "message": code.message,
@@ -376,11 +584,115 @@ async def get_codes(
         "received_at": code.received_at.isoformat()
     } for code in codes]
 
+# 增量同步游标只推进到写入超过该秒数的记录:
+# ID 在 flush 时分配、提交后才可见，并发写入时较小的 ID 可能晚于较大的 ID 提交，
+# 游标停在刚写入的记录之前，可以在下次同步时拿到此时尚未提交的记录
+CODES_SYNC_LAG = 5
+
+
+def _codes_delta(query, since_id: int, limit: int):
+    """增量同步：新记录 + 各账号保留范围"""
+    settled_before = database.utcnow() - timedelta(seconds=CODES_SYNC_LAG)
+    cursor = since_id
+    new_codes = []
+    if limit > 0:
+        new_codes = query.filter(
+            VerificationCode.id > since_id
+        ).order_by(VerificationCode.id).limit(limit).all()
+        # 游标取本次返回的记录，不使用另外查询的最大 ID (两次查询之间可能有新记录提交)
+        # 旧数据没有 created_at，视为早已提交
+        for code in new_codes:
+            if code.created_at is not None and code.created_at >= settled_before:
+                break
+            cursor = code.id
+    else:
+        settled_max = query.filter(
+            VerificationCode.id > since_id,
+            or_(VerificationCode.created_at == None, VerificationCode.created_at < settled_before)
+        ).with_entities(func.max(VerificationCode.id)).scalar()
+        cursor = settled_max or since_id
+    
+    ranges = query.with_entities(
+        VerificationCode.account_id,
+        func.min(VerificationCode.id)
+    ).group_by(VerificationCode.account_id).all()
+    
+    # 游标停在刚写入的记录之前时不再继续拉取，等下次轮询
+    has_more = limit > 0 and len(new_codes) == limit and cursor == new_codes[-1].id
+    
+    return {
+        "cursor": cursor,
+        "has_more": has_more,
+        "codes": [{
+            "id": code.id,
+            "account_id": code.account_id,
+            "phone": code.phone,
+            "code": code.code,
+            "message": code.message,
+            "service": code.service,
+            "received_at": code.received_at.isoformat()
+        } for code in new_codes],
+        "min_ids": {str(acc_id): min_id for acc_id, min_id in ranges}
+    }
+
+@app.get("/api/codes/search")
+async def search_codes(
+    q: str,
+    account_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: int = 20,
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_user_readonly)
+):
+    """搜索验证码消息
+
+    - 消息内容按词前缀全文检索 (多个词需同时出现)
+    - 纯数字时同时按验证码前缀匹配
+    - 按 id 倒序分页：下一页传入上一页返回的 next_before_id
+    """
+    words = re.findall(r'\w+', q)
+    if not words:
+        raise HTTPException(status_code=400, detail="请输入搜索关键词")
+    limit = max(1, min(limit, 100))
+    
+    # 每个词做前缀匹配: foo:* & bar:*
+    ts_query = func.to_tsquery(literal_column("'simple'"), ' & '.join(f"{word}:*" for word in words))
+    conditions = [message_tsvector(VerificationCode.message).op('@@')(ts_query)]
+    keyword = q.strip()
+    if keyword.isdigit():
+        conditions.append(VerificationCode.code.like(f"{keyword}%"))
+    
+    query = db.query(VerificationCode).join(
+        Account, VerificationCode.account_id == Account.id
+    ).filter(
+        Account.user_id == current_user.id,
+        or_(*conditions)
+    )
+    if account_id:
+        query = query.filter(Account.id == account_id)
+    if before_id:
+        query = query.filter(VerificationCode.id < before_id)
+    
+    codes = query.order_by(VerificationCode.id.desc()).limit(limit).all()
+    
+    return {
+        "items": [{
+            "id": code.id,
+            "account_id": code.account_id,
+            "phone": code.phone,
+            "code": code.code,
+            "message": code.message,
+            "service": code.service,
+            "received_at": code.received_at.isoformat()
+        } for code in codes],
+        "next_before_id": codes[-1].id if len(codes) == limit else None
+    }
+
 @app.get("/api/codes/latest/account/{account_id}")
 async def get_latest_code_by_id(
     account_id: int, 
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_user_readonly)
 ):
     """获取指定账号ID的最新验证码"""
     # 检查该账号是否属于当前用户
@@ -400,6 +712,7 @@ async def get_latest_code_by_id(
         raise HTTPException(status_code=404, detail="未找到验证码")
     
     return {
+        "id": code.id,
         "code": code.code,
         "message": code.message,
         "received_at": code.received_at.isoformat()
@@ -408,8 +721,8 @@ async def get_latest_code_by_id(
 @app.get("/api/codes/latest/{phone}")
 async def get_latest_code(
     phone: str, 
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_user_readonly)
 ):
     """获取指定手机号的最新验证码"""
     # 检查该手机号是否属于当前用户
@@ -430,6 +743,7 @@ async def get_latest_code(
         raise HTTPException(status_code=404, detail="未找到验证码")
     
     return {
+        "id": code.id,
         "code": code.code,
         "message": code.message,
         "received_at": code.received_at.isoformat()
@@ -478,6 +792,137 @@ async def clear_codes(
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- Webhook API ---
+
+def _get_webhook(db: Session, webhook_id: int, user_id: int) -> Webhook:
+    webhook = db.query(Webhook).filter(
+        Webhook.id == webhook_id,
+        Webhook.user_id == user_id
+    ).first()
+    if not webhook:
+        raise HTTPException(status_code=404, detail="Webhook 不存在")
+    return webhook
+
+@app.get("/api/webhooks")
+async def get_webhooks(
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_user_readonly)
+):
+    """获取当前用户的 Webhook 及待推送/死信数量"""
+    webhooks = db.query(Webhook).filter(Webhook.user_id == current_user.id).all()
+    ids = [webhook.id for webhook in webhooks]
+    pending = dict(db.query(WebhookDelivery.webhook_id, func.count(WebhookDelivery.id)).filter(
+        WebhookDelivery.webhook_id.in_(ids)
+    ).group_by(WebhookDelivery.webhook_id).all())
+    dead = dict(db.query(WebhookDeadLetter.webhook_id, func.count(WebhookDeadLetter.id)).filter(
+        WebhookDeadLetter.webhook_id.in_(ids)
+    ).group_by(WebhookDeadLetter.webhook_id).all())
+    return [{
+        "id": webhook.id,
+        "url": webhook.url,
+        "is_active": webhook.is_active,
+        "pending": pending.get(webhook.id, 0),
+        "dead_letters": dead.get(webhook.id, 0),
+        "created_at": webhook.created_at.isoformat()
+    } for webhook in webhooks]
+
+@app.post("/api/webhooks")
+async def create_webhook(
+    req: WebhookRequest,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """添加 Webhook，签名密钥只在创建时返回一次"""
+    import webhooks
+    try:
+        await webhooks.check_url(req.url)
+    except webhooks.UnsafeWebhookURL as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    webhook = Webhook(user_id=current_user.id, url=req.url, secret=secrets.token_hex(32))
+    db.add(webhook)
+    db.commit()
+    db.refresh(webhook)
+    return {
+        "id": webhook.id,
+        "url": webhook.url,
+        "secret": webhook.secret,
+        "is_active": webhook.is_active,
+        "created_at": webhook.created_at.isoformat()
+    }
+
+@app.delete("/api/webhooks/{webhook_id}")
+async def delete_webhook(
+    webhook_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """删除 Webhook (待推送记录和死信由外键级联删除)"""
+    _get_webhook(db, webhook_id, current_user.id)
+    db.query(Webhook).filter(Webhook.id == webhook_id).delete(synchronize_session=False)
+    db.commit()
+    return {"status": "ok", "message": "Webhook 已删除"}
+
+@app.get("/api/webhooks/{webhook_id}/dead-letters")
+async def get_dead_letters(
+    webhook_id: int,
+    limit: int = 50,
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_user_readonly)
+):
+    """查看推送失败的验证码"""
+    _get_webhook(db, webhook_id, current_user.id)
+    letters = db.query(WebhookDeadLetter).filter(
+        WebhookDeadLetter.webhook_id == webhook_id
+    ).order_by(WebhookDeadLetter.id.desc()).limit(max(1, min(limit, 500))).all()
+    return [{
+        "id": letter.id,
+        "payload": json.loads(letter.payload),
+        "attempts": letter.attempts,
+        "last_error": letter.last_error,
+        "failed_at": letter.failed_at.isoformat()
+    } for letter in letters]
+
+@app.post("/api/webhooks/{webhook_id}/dead-letters/retry")
+async def retry_dead_letters(
+    webhook_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """将死信重新放回推送队列"""
+    _get_webhook(db, webhook_id, current_user.id)
+    import webhooks
+    count = webhooks.requeue_dead_letters(db, webhook_id)
+    return {"status": "ok", "message": f"已重新排队 {count} 条"}
+
+# --- 管理员 API ---
+
+@app.post("/api/admin/profile")
+async def start_profile(
+    req: ProfileRequest,
+    admin: User = Depends(get_admin_user)
+):
+    """开启性能分析：不传 threshold_ms 时采样整个时间窗口，否则只输出超过阈值的慢请求/定时任务"""
+    if not 1 <= req.seconds <= config.PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds 必须在 1-{config.PROFILE_MAX_SECONDS} 之间")
+    try:
+        profiling.profiler.start(req.seconds, req.threshold_ms)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"status": "ok", **profiling.profiler.status()}
+
+@app.get("/api/admin/profile")
+async def get_profile_status(admin: User = Depends(get_admin_user)):
+    """查看性能分析状态和最近的采样文件"""
+    files = sorted(os.listdir(profiling.PROFILE_DIR))[-20:] if os.path.isdir(profiling.PROFILE_DIR) else []
+    return {**profiling.profiler.status(), "files": files}
+
+@app.delete("/api/admin/profile")
+async def stop_profile(admin: User = Depends(get_admin_user)):
+    """提前结束性能分析"""
+    profiling.profiler.stop()
+    return {"status": "ok"}
+
 if __name__ == "__main__":
     import uvicorn
     # 使用 log_config=None 以使用上面配置的 logging 格式
@@ -0,0 +1,217 @@
+"""按需性能分析 (管理员通过 /api/admin/profile 开启)
+
+- 开启期间后台线程按 PROFILE_SAMPLE_INTERVAL 采样所有线程的调用栈
+- 不指定阈值时，N 秒后输出整个时间窗口的采样和各阶段累计耗时
+- 指定 threshold_ms 时，只为耗时超过阈值的请求/定时任务输出该时间段内的采样和阶段耗时
+- 采样输出为 folded 格式 (flamegraph.pl / speedscope 可直接读取)，写入 logs/profiles/
+- 未开启时 stage() 只读取一次上下文变量，begin() 只比较一次时间，几乎没有额外开销
+"""
+import itertools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+import config
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.path.join(config.LOG_DIR, 'profiles')
+
+# 采样缓冲区上限 (超出后丢弃最早的采样)
+MAX_SAMPLES = 200000
+
+_trace = ContextVar('profile_trace', default=None)
+
+# 输出文件序号，避免同一秒内的文件重名
+_file_seq = itertools.count(1)
+
+class Trace:
+    """一次请求或定时任务的阶段耗时"""
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.monotonic()
+        self.ended = None
+        self.stages = []
+        self.token = None
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.ended or time.monotonic()) - self.started) * 1000
+
+class _Stage:
+    __slots__ = ('trace', 'name', 'started')
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.stages.append((self.name, (time.perf_counter() - self.started) * 1000))
+        return False
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+def stage(name: str):
+    """记录一个阶段的耗时 (当前请求/任务未在分析中时不做任何事)"""
+    trace = _trace.get()
+    return _NULL_STAGE if trace is None else _Stage(trace, name)
+
+def summarize(stages) -> dict:
+    """按阶段名汇总: {name: (总耗时 ms, 次数)}"""
+    totals = {}
+    for name, ms in stages:
+        total, count = totals.get(name, (0.0, 0))
+        totals[name] = (total + ms, count + 1)
+    return totals
+
+def format_stages(totals: dict) -> str:
+    return ', '.join(
+        f"{name}={total:.1f}ms" + (f"x{count}" if count > 1 else '')
+        for name, (total, count) in sorted(totals.items(), key=lambda item: -item[1][0])
+    ) or '无'
+
+class Profiler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=MAX_SAMPLES)
+        self._stage_totals = {}
+        self._thread = None
+        self.until = 0.0
+        self.threshold_ms = None
+
+    @property
+    def active(self) -> bool:
+        return time.monotonic() < self.until
+
+    def start(self, seconds: int, threshold_ms: int = None):
+        """开启采样 seconds 秒；threshold_ms 为空时输出整个窗口，否则只输出慢请求"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                raise RuntimeError("性能分析正在进行中")
+            self._samples.clear()
+            self._stage_totals = {}
+            self.threshold_ms = threshold_ms
+            self.until = time.monotonic() + seconds
+            self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self._thread.start()
+        mode = f"慢请求阈值 {threshold_ms}ms" if threshold_ms is not None else "完整窗口"
+        logger.info(f"🔬 性能分析已开启 {seconds} 秒 ({mode})")
+
+    def stop(self):
+        self.until = 0.0
+
+    def status(self) -> dict:
+        return {
+            "active": self.active,
+            "remaining": max(0, int(self.until - time.monotonic())),
+            "threshold_ms": self.threshold_ms,
+            "samples": len(self._samples)
+        }
+
+    def _run(self):
+        started = time.monotonic()
+        own = threading.get_ident()
+        while self.active:
+            self._sample(own)
+            time.sleep(config.PROFILE_SAMPLE_INTERVAL)
+
+        if self.threshold_ms is None:
+            path = self.write('window', started, time.monotonic())
+            with self._lock:
+                totals = self._stage_totals
+            logger.info(f"🔬 性能分析结束，采样已写入 {path}；阶段耗时: {format_stages(totals)}")
+        else:
+            logger.info("🔬 性能分析结束")
+
+    def _sample(self, own_ident: int):
+        now = time.monotonic()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stacks.append((now, ';'.join(reversed(stack))))
+        with self._lock:
+            self._samples.extend(stacks)
+
+    def add_stages(self, stages):
+        with self._lock:
+            for name, (total, count) in summarize(stages).items():
+                prev_total, prev_count = self._stage_totals.get(name, (0.0, 0))
+                self._stage_totals[name] = (prev_total + total, prev_count + count)
+
+    def write(self, label: str, started: float, ended: float):
+        """将时间段内的采样写入 folded 文件，返回文件路径"""
+        with self._lock:
+            stacks = Counter(stack for ts, stack in self._samples if started <= ts <= ended)
+        if not stacks:
+            return None
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        label = re.sub(r'[^\w.-]+', '_', label).strip('_')[:60]
+        path = os.path.join(PROFILE_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{next(_file_seq)}-{label}.folded")
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+profiler = Profiler()
+
+def begin(name: str):
+    """开始记录一次请求/任务，未开启分析时返回 None"""
+    if not profiler.active:
+        return None
+    trace = Trace(name)
+    trace.token = _trace.set(trace)
+    return trace
+
+def end(trace: Trace) -> bool:
+    """结束记录，返回是否为需要输出报告的慢请求"""
+    trace.ended = time.monotonic()
+    _trace.reset(trace.token)
+    if profiler.threshold_ms is None:
+        profiler.add_stages(trace.stages)
+        return False
+    return trace.duration_ms >= profiler.threshold_ms
+
+def report(trace: Trace):
+    """输出慢请求的阶段耗时和采样 (会写文件，异步代码中应放到线程池执行)"""
+    path = profiler.write(trace.name, trace.started, trace.ended)
+    logger.warning(
+        f"🐢 {trace.name} 耗时 {trace.duration_ms:.0f}ms，阶段耗时: {format_stages(summarize(trace.stages))}"
+        + (f"，采样已写入 {path}" if path else ''),
+        extra={"duration_ms": round(trace.duration_ms, 1)}
+    )
+
+@contextmanager
+def profiled(name: str):
+    """同步代码 (定时任务) 使用的 begin/end/report"""
+    trace = begin(name)
+    try:
+        yield
+    finally:
+        if trace is not None and end(trace):
+            report(trace)
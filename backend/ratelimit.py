@@ -0,0 +1,250 @@
+"""Telegram RPC 限流
+
+所有 Telethon 调用前都需要从两个令牌桶各取一个令牌：
+- 账号桶：限制单个账号 (手机号) 的请求频率
+- API 桶：限制同一个 API 凭证 (api_id) 下所有账号的总请求频率
+
+收到 FloodWaitError 时，将该账号暂停 (park) 到 Telegram 要求的时间之后，
+期间对该账号的调用直接抛出 AccountParked，由调用方决定稍后重试。
+
+令牌桶使用线程锁保护，API 事件循环和调度器线程中的事件循环可以共享同一个限流器。
+TG_RATE_LIMIT_BACKEND=postgres 时 API 桶和暂停状态存放在数据库中，API 进程和各分片 worker 共享。
+"""
+import asyncio
+import logging
+import threading
+import time
+from sqlalchemy import text
+import config
+
+logger = logging.getLogger(__name__)
+
+class AccountParked(Exception):
+    """账号因 FloodWait 被暂停"""
+    def __init__(self, key: str, seconds: float):
+        self.key = key
+        self.seconds = max(1, int(seconds + 0.999))
+        super().__init__(f"请求过于频繁，请 {self.seconds} 秒后再试")
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        """预占一个令牌，返回需要等待的秒数 (令牌可以透支，等待期间即为偿还)"""
+        self.refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class MemoryState:
+    """进程内的令牌桶和账号暂停状态"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        # key -> 暂停截止时间 (monotonic)
+        self._parked = {}
+
+    def reserve(self, buckets) -> float:
+        """从多个桶 [(key, rate, burst), ...] 各预占一个令牌，返回需要等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            for key, rate, burst in buckets:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = TokenBucket(rate, burst)
+                wait = max(wait, bucket.reserve(now))
+            return wait
+
+    def parked_for(self, key: str) -> float:
+        with self._lock:
+            until = self._parked.get(key)
+            if until is None:
+                return 0.0
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                del self._parked[key]
+                return 0.0
+            return remaining
+
+    def park(self, key: str, seconds: float):
+        with self._lock:
+            until = time.monotonic() + seconds
+            self._parked[key] = max(until, self._parked.get(key, 0))
+
+    def snapshot(self):
+        """返回 ({桶 key: 当前令牌数 (未截断到容量)}, {账号: 剩余暂停秒数})"""
+        with self._lock:
+            now = time.monotonic()
+            return {
+                key: bucket.tokens + (now - bucket.updated) * bucket.rate
+                for key, bucket in self._buckets.items()
+            }, {
+                key: until - now for key, until in self._parked.items() if until > now
+            }
+
+class PostgresState:
+    """API 进程和各分片 worker 共享的限流状态
+
+    令牌桶存放在 api_rate_limits 表 (键加 telegram: 前缀，与 API 限流的键区分)，
+    账号暂停状态存放在 telegram_flood_waits 表；时间统一使用数据库时钟。
+    """
+    KEY_PREFIX = 'telegram:'
+
+    # 与 TokenBucket.reserve 相同：令牌可以透支，返回透支后的余量
+    RESERVE_SQL = text("""
+        INSERT INTO api_rate_limits (key, tokens, updated_at)
+        VALUES (:key, :capacity - 1, now())
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = LEAST(:capacity, api_rate_limits.tokens
+                + EXTRACT(EPOCH FROM now() - api_rate_limits.updated_at) * :rate) - 1,
+            updated_at = now()
+        RETURNING tokens
+    """)
+
+    PARKED_FOR_SQL = text("""
+        SELECT EXTRACT(EPOCH FROM until - now()) FROM telegram_flood_waits
+        WHERE key = :key AND until > now()
+    """)
+
+    PARK_SQL = text("""
+        INSERT INTO telegram_flood_waits (key, until)
+        VALUES (:key, now() + make_interval(secs => :seconds))
+        ON CONFLICT (key) DO UPDATE SET until = GREATEST(telegram_flood_waits.until, EXCLUDED.until)
+    """)
+
+    # 暂停早已结束的记录在下次 park 时顺带清理
+    PRUNE_SQL = text("DELETE FROM telegram_flood_waits WHERE until < now() - interval '1 day'")
+
+    # 令牌数在 Python 中按各自的速率补充
+    BUCKETS_SQL = text("""
+        SELECT key, tokens, EXTRACT(EPOCH FROM now() - updated_at) FROM api_rate_limits
+        WHERE key LIKE :prefix
+    """)
+
+    PARKED_SQL = text("""
+        SELECT key, EXTRACT(EPOCH FROM until - now()) FROM telegram_flood_waits WHERE until > now()
+    """)
+
+    def __init__(self, rates):
+        # 桶类型 (account / api) -> 每秒补充的令牌数
+        self.rates = rates
+
+    def reserve(self, buckets) -> float:
+        from database import SessionLocal
+        db = SessionLocal()
+        wait = 0.0
+        try:
+            for key, rate, burst in buckets:
+                tokens = float(db.execute(self.RESERVE_SQL, {
+                    "key": f"{self.KEY_PREFIX}{key}", "rate": rate, "capacity": burst
+                }).scalar())
+                if tokens < 0:
+                    wait = max(wait, -tokens / rate)
+            db.commit()
+        finally:
+            db.close()
+        return wait
+
+    def parked_for(self, key: str) -> float:
+        from database import SessionLocal
+        db = SessionLocal()
+        try:
+            remaining = db.execute(self.PARKED_FOR_SQL, {"key": key}).scalar()
+            db.rollback()
+        finally:
+            db.close()
+        return float(remaining) if remaining is not None else 0.0
+
+    def park(self, key: str, seconds: float):
+        from database import SessionLocal
+        db = SessionLocal()
+        try:
+            db.execute(self.PARK_SQL, {"key": key, "seconds": float(seconds)})
+            db.execute(self.PRUNE_SQL)
+            db.commit()
+        finally:
+            db.close()
+
+    def snapshot(self):
+        from database import SessionLocal
+        db = SessionLocal()
+        try:
+            buckets = db.execute(self.BUCKETS_SQL, {"prefix": f"{self.KEY_PREFIX}%"}).all()
+            parked = db.execute(self.PARKED_SQL).all()
+            db.rollback()
+        finally:
+            db.close()
+        tokens = {}
+        for key, value, elapsed in buckets:
+            key = key[len(self.KEY_PREFIX):]
+            tokens[key] = float(value) + float(elapsed) * self.rates[key.split(':', 1)[0]]
+        return tokens, {key: float(remaining) for key, remaining in parked}
+
+class TelegramRateLimiter:
+    def __init__(self, account_rate: float, account_burst: float, api_rate: float, api_burst: float, state=None):
+        self.account_rate = account_rate
+        self.account_burst = account_burst
+        self.api_rate = api_rate
+        self.api_burst = api_burst
+        self.state = state or MemoryState()
+
+    def parked_for(self, key: str) -> float:
+        """账号剩余暂停秒数，未暂停返回 0"""
+        return self.state.parked_for(key)
+
+    def park(self, key: str, seconds: float):
+        """按 FloodWaitError.seconds 暂停账号"""
+        self.state.park(key, seconds)
+        logger.warning(f"⏸️ 账号 {key} 触发 FloodWait，暂停 {int(seconds)} 秒", extra={"phone": key})
+
+    async def acquire(self, key: str, api_id: int = None):
+        """取得一次调用许可；令牌不足时等待，账号被暂停时抛出 AccountParked"""
+        remaining = self.parked_for(key)
+        if remaining > 0:
+            raise AccountParked(key, remaining)
+
+        api_id = api_id or config.API_ID
+        wait = self.state.reserve([
+            (f"account:{key}", self.account_rate, self.account_burst),
+            (f"api:{api_id}", self.api_rate, self.api_burst),
+        ])
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def snapshot(self, keys=None) -> dict:
+        """当前令牌桶状态，keys 用于只返回指定账号"""
+        tokens, parked = self.state.snapshot()
+        result = {"api": {}, "accounts": {}}
+        for bucket_key, value in tokens.items():
+            kind, _, key = bucket_key.partition(':')
+            if kind == 'api':
+                result["api"][key] = self._bucket_snapshot(value, self.api_rate, self.api_burst)
+            elif keys is None or key in keys:
+                result["accounts"][key] = self._bucket_snapshot(value, self.account_rate, self.account_burst)
+        result["parked"] = {
+            key: int(remaining) for key, remaining in parked.items() if keys is None or key in keys
+        }
+        return result
+
+    @staticmethod
+    def _bucket_snapshot(tokens: float, rate: float, capacity: float) -> dict:
+        return {"tokens": round(min(capacity, tokens), 2), "capacity": capacity, "rate": rate}
+
+limiter = TelegramRateLimiter(
+    account_rate=config.TG_ACCOUNT_RATE,
+    account_burst=config.TG_ACCOUNT_BURST,
+    api_rate=config.TG_API_RATE,
+    api_burst=config.TG_API_BURST,
+    state=PostgresState({
+        "account": config.TG_ACCOUNT_RATE,
+        "api": config.TG_API_RATE
+    }) if config.TG_RATE_LIMIT_BACKEND == 'postgres' else None
+)
@@ -1,14 +1,44 @@
 from telethon import TelegramClient
-from telethon.errors import SessionPasswordNeededError
+from telethon.errors import SessionPasswordNeededError, FloodWaitError, ApiIdInvalidError, ApiIdPublishedFloodError
+import asyncio
+import logging
 import os
 import re
+import time
 from datetime import datetime, timedelta, timezone
 import config
 from database import SessionLocal, Account, VerificationCode
+from ratelimit import limiter, AccountParked
+from credentials import pool
+from profiling import stage
+import webhooks
+
+logger = logging.getLogger(__name__)
 
 # 用于临时存储登录过程中的 client
 _login_clients = {}
 
+def new_client(session_path: str, api_id: int = None, **kwargs) -> TelegramClient:
+    """使用账号绑定的凭证创建 TelegramClient (FloodWait 由限流器处理，不在 Telethon 内部自动休眠)"""
+    credential = pool.get(api_id)
+    return TelegramClient(session_path, credential.api_id, credential.api_hash, flood_sleep_threshold=0, **kwargs)
+
+def _flood(key: str, api_id: int, e: FloodWaitError) -> AccountParked:
+    limiter.park(key, e.seconds)
+    pool.record_flood(api_id, e.seconds)
+    return AccountParked(key, e.seconds)
+
+async def limited(key: str, func, *args, **kwargs):
+    """在限流器许可下执行一次 Telegram 调用 (func 为 TelegramClient 的方法，按该 client 的凭证限流和计数)"""
+    api_id = func.__self__.api_id
+    with stage('ratelimit.wait'):
+        await limiter.acquire(key, api_id)
+    with pool.track(api_id), stage(f"telethon.{func.__name__}"):
+        try:
+            return await func(*args, **kwargs)
+        except FloodWaitError as e:
+            raise _flood(key, api_id, e)
+
 async def send_verification_code(phone: str):
     """发送 Telegram 验证码"""
     # 确保目录存在
@@ -17,22 +47,32 @@ async def send_verification_code(phone: str):
     session_name = f"temp_{phone.replace('+', '').replace(' ', '')}"
     session_path = os.path.join(config.SESSION_DIR, session_name)
     
-    client = TelegramClient(session_path, config.API_ID, config.API_HASH)
+    # 新登录的账号分配负载最低的凭证，之后一直使用该凭证
+    db = SessionLocal()
+    try:
+        credential = pool.assign(db)
+    finally:
+        db.close()
+    client = new_client(session_path, credential.api_id)
     
     try:
         await client.connect()
-        await client.send_code_request(phone)
+        await limited(phone, client.send_code_request, phone)
         _login_clients[phone] = client
-        print(f"✅ 验证码已发送到 {phone}")
+        logger.info(f"✅ 验证码已发送到 {phone} (API {credential.api_id})")
     except Exception as e:
         await client.disconnect()
+        if isinstance(e, (ApiIdInvalidError, ApiIdPublishedFloodError)):
+            pool.disable(credential.api_id, str(e))
         # 删除临时 session 文件
         if os.path.exists(f"{session_path}.session"):
             os.remove(f"{session_path}.session")
+        if isinstance(e, AccountParked):
+            raise
         raise Exception(f"发送验证码失败: {str(e)}")
 
 async def verify_and_create_session(phone: str, code: str, password: str = None, target_session_name: str = None):
-    """验证登录并创建 session"""
+    """验证登录并创建 session，返回 (session 名, 绑定的 api_id)"""
     client = _login_clients.get(phone)
     if not client:
         raise Exception("请先发送验证码")
@@ -48,17 +88,17 @@ async def verify_and_create_session(phone: str, code: str, password: str = None,
     try:
         # 尝试登录
         try:
-            await client.sign_in(phone, code)
+            await limited(phone, client.sign_in, phone, code)
         except SessionPasswordNeededError:
             # 需要两步验证密码
             if not password:
                 await client.disconnect()
                 del _login_clients[phone]
                 raise Exception("该账号开启了两步验证，请输入密码")
-            await client.sign_in(password=password)
+            await limited(phone, client.sign_in, password=password)
         
         # 登录成功
-        print(f"✅ 账号 {phone} 登录成功")
+        logger.info(f"✅ 账号 {phone} 登录成功")
         
         # 断开连接
         await client.disconnect()
@@ -72,7 +112,7 @@ async def verify_and_create_session(phone: str, code: str, password: str = None,
             if os.path.exists(new_path):
                 os.remove(new_path)
             os.rename(old_path, new_path)
-            print(f"✅ Session 文件已保存: {final_session_name}.session")
+            logger.info(f"✅ Session 文件已保存: {final_session_name}.session")
         else:
             raise Exception(f"Session 文件不存在: {old_path}")
         
@@ -80,13 +120,11 @@ async def verify_and_create_session(phone: str, code: str, password: str = None,
         if phone in _login_clients:
             del _login_clients[phone]
         
-        return final_session_name
+        return final_session_name, client.api_id
         
     except Exception as e:
-        # 打印详细错误堆栈
-        import traceback
-        traceback.print_exc()
-        print(f"❌ 登录过程出错: {str(e)}")
+        # 记录详细错误堆栈
+        logger.exception(f"❌ 登录过程出错: {str(e)}", extra={"phone": phone})
 
         # 清理
         if client:
@@ -106,6 +144,8 @@ async def verify_and_create_session(phone: str, code: str, password: str = None,
                 pass
         
         # 提取错误信息
+        if isinstance(e, AccountParked):
+            raise
         error_msg = str(e)
         if "PHONE_CODE_INVALID" in error_msg:
             raise Exception("验证码错误，请检查后重试")
@@ -125,78 +165,110 @@ async def delete_session(session_name: str):
     session_path = os.path.join(config.SESSION_DIR, f"{session_name}.session")
     if os.path.exists(session_path):
         os.remove(session_path)
-        print(f"✅ Session 文件已删除: {session_name}")
+        logger.info(f"✅ Session 文件已删除: {session_name}")
 
-async def check_codes_for_account(phone: str, session_name: str, account_id: int = None):
-    """检查单个账号的验证码"""
-    session_path = os.path.join(config.SESSION_DIR, session_name)
+def extract_code(text: str):
+    """从消息文本中提取 5-6 位验证码"""
+    with stage('regex'):
+        code_match = re.search(r'\b(\d{5,6})\b', text)
+    return code_match.group(1) if code_match else None
+
+def store_code(db, phone: str, code: str, message: str, received_at: datetime, account_id: int = None) -> bool:
+    """保存验证码 (最近30分钟内相同验证码视为重复)，返回是否为新验证码"""
+    time_threshold = datetime.now(timezone.utc) - timedelta(minutes=30)
+    with stage('db.dedupe'):
+        existing = db.query(VerificationCode).filter(
+            VerificationCode.phone == phone,
+            VerificationCode.code == code,
+            VerificationCode.received_at >= time_threshold
+        ).first()
+    if existing:
+        return False
     
-    client = TelegramClient(session_path, config.API_ID, config.API_HASH)
+    new_code = VerificationCode(
+        phone=phone,
+        code=code,
+        message=message,
+        received_at=received_at,
+        service="Telegram",
+        account_id=account_id
+    )
+    db.add(new_code)
+    db.flush()
+    # 推送记录与验证码在同一事务中提交
+    webhooks.enqueue_deliveries(db, new_code)
+    with stage('db.commit'):
+        db.commit()
+    logger.info(f"✅ 新验证码: {phone} -> {code}", extra={"account_id": account_id, "phone": phone})
+    return True
+
+async def collect_codes(client: TelegramClient, phone: str, account_id: int = None) -> int:
+    """从已连接的 client 拉取最近30分钟的验证码并入库，返回有效验证码数量"""
     db = SessionLocal()
-    new_codes_count = 0
     valid_codes_count = 0
+    started = time.perf_counter()
     
     try:
-        await client.connect()
-        
-        if not await client.is_user_authorized():
-            print(f"⚠️ 账号 {phone} 未授权 (Session 已失效)")
-            return -1
-        
         # 获取最近30分钟的消息
         time_threshold = datetime.now(timezone.utc) - timedelta(minutes=30)
-        print(f"🔍 正在检查账号 {phone} 的消息 (最近30分钟)...")
+        logger.debug(f"🔍 正在检查账号 {phone} 的消息 (最近30分钟)...")
         
-        # 仅监听官方账号 777000
-        async for message in client.iter_messages(777000, limit=20):
-            if not message.message or message.date < time_threshold:
-                continue
-            
-            # 提取验证码
-            code_match = re.search(r'\b(\d{5,6})\b', message.message)
-            if code_match:
-                valid_codes_count += 1
-                code = code_match.group(1)
-                
-                # 检查是否已存在
-                existing = db.query(VerificationCode).filter(
-                    VerificationCode.phone == phone,
-                    VerificationCode.code == code,
-                    VerificationCode.received_at >= time_threshold
-                ).first()
-                
-                if not existing:
-                    new_code = VerificationCode(
-                        phone=phone,
-                        code=code,
-                        message=message.message,
-                        received_at=message.date,
-                        service="Telegram",
-                        account_id=account_id
-                    )
-                    db.add(new_code)
-                    db.commit()
-                    new_codes_count += 1
-                    print(f"✅ 新验证码: {phone} -> {code}")
+        # 仅监听官方账号 777000 (一次拉取计为一次调用)
+        with stage('ratelimit.wait'):
+            await limiter.acquire(phone, client.api_id)
+        with pool.track(client.api_id), stage('telethon.iter_messages'):
+            try:
+                async for message in client.iter_messages(777000, limit=20):
+                    if not message.message or message.date < time_threshold:
+                        continue
+                    
+                    # 提取验证码
+                    code = extract_code(message.message)
+                    if code:
+                        valid_codes_count += 1
+                        store_code(db, phone, code, message.message, message.date, account_id)
+            except FloodWaitError as e:
+                raise _flood(phone, client.api_id, e)
         
+        logger.debug(f"🔍 账号 {phone} 检查完成，有效验证码 {valid_codes_count} 个", extra={
+            "account_id": account_id,
+            "phone": phone,
+            "duration_ms": round((time.perf_counter() - started) * 1000)
+        })
         return valid_codes_count
+    finally:
+        db.close()
+
+async def check_codes_for_account(phone: str, session_name: str, account_id: int = None, api_id: int = None):
+    """检查单个账号的验证码"""
+    session_path = os.path.join(config.SESSION_DIR, session_name)
+    
+    client = new_client(session_path, api_id)
+    
+    try:
+        with stage('telethon.connect'):
+            await client.connect()
+        
+        if not await limited(phone, client.is_user_authorized):
+            logger.warning(f"⚠️ 账号 {phone} 未授权 (Session 已失效)")
+            return -1
+        
+        return await collect_codes(client, phone, account_id)
     
+    except AccountParked:
+        raise
     except Exception as e:
-        print(f"❌ 检查账号 {phone} 时出错: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ 检查账号 {phone} 时出错: {e}", extra={"account_id": account_id, "phone": phone})
         return 0
     
     finally:
         await client.disconnect()
-        db.close()
 
-async def keep_alive_account(phone: str, session_name: str, account_id: int):
+async def keep_alive_account(phone: str, session_name: str, account_id: int, api_id: int = None):
     """仅进行 Session 保活，不检查验证码"""
-    client = TelegramClient(
+    client = new_client(
         f"sessions/{session_name}", 
-        config.API_ID, 
-        config.API_HASH,
+        api_id,
         device_model="Desktop",
         system_version="Linux",
         app_version="1.0",
@@ -205,31 +277,34 @@ async def keep_alive_account(phone: str, session_name: str, account_id: int):
     
     db = SessionLocal()
     try:
-        await client.connect()
+        with stage('telethon.connect'):
+            await client.connect()
         
-        if not await client.is_user_authorized():
-            print(f"⚠️ 保活失败: 账号 {phone} 未授权 (Session 已失效)")
+        if not await limited(phone, client.is_user_authorized):
+            logger.warning(f"⚠️ 保活失败: 账号 {phone} 未授权 (Session 已失效)")
             # 更新数据库状态
             account = db.query(Account).filter(Account.id == account_id).first()
             if account:
                 account.is_active = False
                 db.commit()
-                print(f"❌ 已将账号 {phone} 标记为失效")
+                logger.error(f"❌ 已将账号 {phone} 标记为失效")
             return
         
         # 获取自身信息作为保活操作
-        me = await client.get_me()
-        print(f"✅ 账号保活成功: {phone} (ID: {me.id})")
+        me = await limited(phone, client.get_me)
+        logger.info(f"✅ 账号保活成功: {phone} (ID: {me.id})")
         
         # 确保状态为活跃
         account = db.query(Account).filter(Account.id == account_id).first()
         if account and not account.is_active:
             account.is_active = True
             db.commit()
-            print(f"✅ 已将账号 {phone} 重新标记为活跃")
+            logger.info(f"✅ 已将账号 {phone} 重新标记为活跃")
         
+    except AccountParked:
+        raise
     except Exception as e:
-        print(f"❌ 账号保活出错 {phone}: {e}")
+        logger.error(f"❌ 账号保活出错 {phone}: {e}", extra={"account_id": account_id, "phone": phone})
     
     finally:
         await client.disconnect()
@@ -244,10 +319,11 @@ async def keep_alive_all_accounts():
     accounts = db.query(Account).filter(Account.is_active == True).all()
     db.close()
     
-    print(f"🔄 开始执行账号保活任务 ({len(accounts)} 个账号)...")
+    logger.info(f"🔄 开始执行账号保活任务 ({len(accounts)} 个账号)...")
     
-    for account in accounts:
-        await keep_alive_account(account.phone, account.session_name, account.id)
+    # 通过任务队列执行，与同一账号的手动检查合并/串行
+    import jobs
+    await _sweep(accounts, lambda account: jobs.run_job(account.id, 'keep_alive'))
 
 async def check_all_accounts():
     """检查所有账号的验证码"""
@@ -255,7 +331,26 @@ async def check_all_accounts():
     accounts = db.query(Account).filter(Account.is_active == True).all()
     db.close()
     
-    print(f"🔍 开始检查 {len(accounts)} 个账号...")
+    logger.info(f"🔍 开始检查 {len(accounts)} 个账号...")
     
+    await _sweep(accounts, lambda account: check_codes_for_account(account.phone, account.session_name, account_id=account.id, api_id=account.api_id))
+
+async def _sweep(accounts, run):
+    """依次处理账号；被 FloodWait 暂停的账号顺延到本轮末尾，等暂停结束后重试一次"""
+    deferred = []
     for account in accounts:
-        await check_codes_for_account(account.phone, account.session_name, account_id=account.id)
+        try:
+            await run(account)
+        except AccountParked as e:
+            deferred.append((e.seconds, account))
+    
+    for _, account in sorted(deferred, key=lambda item: item[0]):
+        wait = limiter.parked_for(account.phone)
+        if wait > config.TG_FLOOD_RETRY_MAX_WAIT:
+            logger.warning(f"⏭️ 账号 {account.phone} 暂停时间过长 ({int(wait)} 秒)，留到下一轮处理")
+            continue
+        await asyncio.sleep(wait)
+        try:
+            await run(account)
+        except AccountParked:
+            logger.warning(f"⏭️ 账号 {account.phone} 再次触发 FloodWait，留到下一轮处理")
@@ -0,0 +1,269 @@
+"""独立的 Receiver Worker 进程
+
+每个 worker 按账号 ID 分片，负责自己分片内账号的 Telegram 长连接：
+实时接收 777000 的消息入库，并执行 API 通过 receiver_jobs 表下发的任务。
+
+用法:
+    python -m receiver_worker --shard 0/2
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+import psycopg2
+from sqlalchemy.exc import IntegrityError
+from telethon import events
+import config
+import jobs
+import receiver
+from database import SessionLocal, Account
+from log_config import setup_logging
+from ratelimit import AccountParked
+
+logger = logging.getLogger(__name__)
+
+class ReceiverWorker:
+    def __init__(self, shard_index: int, shard_total: int):
+        self.shard_index = shard_index
+        self.shard_total = shard_total
+        # account_id -> (Account 快照, TelegramClient)
+        self.clients = {}
+        # account_id -> 正在执行的任务 (同一账号同时最多一个任务)
+        self.running = {}
+        # 收到删除通知、等待断开的账号
+        self.removed = set()
+        self._wakeup = asyncio.Event()
+        self._listen_conn = None
+
+    async def run(self):
+        logger.info(f"🚀 Receiver Worker 启动 (分片 {self.shard_index}/{self.shard_total})")
+        self._listen()
+        self.expire_stale_jobs()
+        await self.refresh_accounts()
+
+        loop = asyncio.get_running_loop()
+        next_refresh = loop.time() + config.RECEIVER_REFRESH_INTERVAL
+
+        try:
+            while True:
+                await self.disconnect_removed()
+                await self.process_jobs()
+
+                if loop.time() >= next_refresh:
+                    self.expire_stale_jobs()
+                    await self.refresh_accounts()
+                    next_refresh = loop.time() + config.RECEIVER_REFRESH_INTERVAL
+
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=config.RECEIVER_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+        finally:
+            for task in self.running.values():
+                task.cancel()
+            await asyncio.gather(*self.running.values(), return_exceptions=True)
+            for account_id in list(self.clients):
+                await self._disconnect(account_id)
+            if self._listen_conn:
+                self._listen_conn.close()
+
+    def _listen(self):
+        """LISTEN 任务和账号删除通道，有通知时立即唤醒主循环 (否则退化为定时轮询)"""
+        try:
+            conn = psycopg2.connect(config.DATABASE_URL)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute(f"LISTEN {jobs.JOB_CHANNEL}; LISTEN {jobs.ACCOUNT_CHANNEL}")
+        except Exception as e:
+            logger.warning(f"⚠️ 无法订阅任务通知，改为轮询模式: {e}")
+            return
+
+        def on_notify():
+            conn.poll()
+            if conn.notifies:
+                for notify in conn.notifies:
+                    if notify.channel == jobs.ACCOUNT_CHANNEL:
+                        self.removed.update(int(account_id) for account_id in notify.payload.split(','))
+                conn.notifies.clear()
+                self._wakeup.set()
+
+        asyncio.get_running_loop().add_reader(conn.fileno(), on_notify)
+        self._listen_conn = conn
+
+    def expire_stale_jobs(self):
+        """释放中断的任务 (上次 worker 退出时正在执行的任务会一直停留在 running)"""
+        db = SessionLocal()
+        try:
+            jobs.expire_stale_jobs(db)
+        finally:
+            db.close()
+
+    async def disconnect_removed(self):
+        """断开已删除的账号 (不在本分片的账号直接忽略)"""
+        removed, self.removed = self.removed, set()
+        for account_id in removed:
+            if account_id in self.clients:
+                await self._disconnect(account_id)
+
+    async def refresh_accounts(self):
+        """同步分片内的活跃账号：连接新增账号，断开已删除或失效的账号"""
+        db = SessionLocal()
+        try:
+            accounts = db.query(Account).filter(
+                Account.is_active == True,
+                Account.id % self.shard_total == self.shard_index
+            ).all()
+            owned = {acc.id: acc for acc in accounts}
+            for acc in owned.values():
+                db.expunge(acc)
+        finally:
+            db.close()
+
+        for account_id in list(self.clients):
+            cached, _ = self.clients[account_id]
+            current = owned.get(account_id)
+            # 重新登录后 Session 或绑定的凭证可能已变化，需要重新连接
+            if current is None or (current.session_name, current.api_id) != (cached.session_name, cached.api_id):
+                await self._disconnect(account_id)
+
+        for account_id, acc in owned.items():
+            if account_id not in self.clients:
+                await self._connect(acc)
+
+    async def _connect(self, account: Account):
+        session_path = os.path.join(config.SESSION_DIR, account.session_name)
+        client = receiver.new_client(session_path, account.api_id)
+        try:
+            await client.connect()
+            if not await receiver.limited(account.phone, client.is_user_authorized):
+                logger.warning(f"⚠️ 账号 {account.phone} 未授权 (Session 已失效)")
+                await client.disconnect()
+                self._mark_active(account.id, False)
+                return
+        except Exception as e:
+            logger.error(f"❌ 连接账号 {account.phone} 失败: {e}")
+            await client.disconnect()
+            return
+
+        async def on_message(event):
+            code = receiver.extract_code(event.message.message or '')
+            if not code:
+                return
+            db = SessionLocal()
+            try:
+                receiver.store_code(db, account.phone, code, event.message.message, event.message.date, account.id)
+            except IntegrityError:
+                # 账号已被删除 (删除通知尚未处理)，丢弃该消息并断开
+                db.rollback()
+                logger.info(f"账号 {account.phone} 已删除，忽略新消息")
+                self.removed.add(account.id)
+                self._wakeup.set()
+            finally:
+                db.close()
+
+        client.add_event_handler(on_message, events.NewMessage(chats=777000))
+        self.clients[account.id] = (account, client)
+        logger.info(f"✅ 已连接账号 {account.phone}")
+
+    async def _disconnect(self, account_id: int):
+        account, client = self.clients.pop(account_id)
+        try:
+            await client.disconnect()
+        except Exception:
+            pass
+        logger.info(f"🔌 已断开账号 {account.phone}")
+
+    def _mark_active(self, account_id: int, is_active: bool):
+        db = SessionLocal()
+        try:
+            account = db.query(Account).filter(Account.id == account_id).first()
+            if account and account.is_active != is_active:
+                account.is_active = is_active
+                db.commit()
+        finally:
+            db.close()
+
+    async def process_jobs(self):
+        """并发执行分片内账号的待处理任务 (包括未连接的失效账号，手动检查可以恢复它们)"""
+        free = config.RECEIVER_CONCURRENCY - len(self.running)
+        if free <= 0:
+            return
+        # 只认领空闲并发数量的任务，认领后立即执行，租约从真正开始执行时计算
+        db = SessionLocal()
+        try:
+            claimed = [
+                (job.id, job.account_id, job.kind)
+                for job in jobs.claim_jobs(db, self.shard_index, self.shard_total, limit=free, busy_accounts=self.running)
+            ]
+        finally:
+            db.close()
+
+        for job_id, account_id, kind in claimed:
+            task = asyncio.create_task(self._run_job(job_id, account_id, kind))
+            self.running[account_id] = task
+            task.add_done_callback(lambda _, account_id=account_id: self._job_done(account_id))
+
+    def _job_done(self, account_id: int):
+        self.running.pop(account_id, None)
+        # 空出并发名额，立即认领下一个任务
+        self._wakeup.set()
+
+    async def _run_job(self, job_id: int, account_id: int, kind: str):
+        result, error = None, None
+        started = time.perf_counter()
+        try:
+            result = await self._handle_job(account_id, kind)
+        except AccountParked as e:
+            error = jobs.encode_parked(e)
+            logger.warning(f"⏸️ 任务 {job_id} ({kind}) 因 FloodWait 推迟: {e}")
+        except Exception as e:
+            error = str(e)
+            logger.exception(f"❌ 任务 {job_id} ({kind}) 执行失败: {e}", extra={"job_id": job_id, "account_id": account_id})
+        else:
+            logger.info(f"✅ 任务 {job_id} ({kind}) 执行完成", extra={
+                "job_id": job_id,
+                "account_id": account_id,
+                "duration_ms": round((time.perf_counter() - started) * 1000)
+            })
+
+        db = SessionLocal()
+        try:
+            jobs.finish_job(db, job_id, result=result, error=error)
+        finally:
+            db.close()
+
+    async def _handle_job(self, account_id: int, kind: str) -> int:
+        if account_id in self.clients:
+            account, client = self.clients[account_id]
+            if kind == 'check':
+                return await receiver.collect_codes(client, account.phone, account.id)
+            if kind == 'keep_alive':
+                await receiver.limited(account.phone, client.get_me)
+                return 0
+            raise ValueError(f"未知任务类型: {kind}")
+
+        # 未保持连接的账号 (失效或新添加)，走一次性连接流程
+        return await jobs.run_local(account_id, kind)
+
+def parse_shard(value: str):
+    """解析 i/N 格式的分片参数"""
+    try:
+        index, total = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("分片格式应为 i/N，例如 0/2")
+    if total <= 0 or not 0 <= index < total:
+        raise argparse.ArgumentTypeError("分片编号必须满足 0 <= i < N")
+    return index, total
+
+def main():
+    parser = argparse.ArgumentParser(description="Telegram Receiver Worker")
+    parser.add_argument('--shard', type=parse_shard, default=(0, 1), help="分片编号，格式 i/N (默认 0/1)")
+    args = parser.parse_args()
+    setup_logging(f"receiver_worker_{args.shard[0]}")
+
+    worker = ReceiverWorker(*args.shard)
+    asyncio.run(worker.run())
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,14 @@ def reset_db():
     try:
         # Drop all tables
         with engine.connect() as conn:
+            conn.execute(text("DROP TABLE IF EXISTS webhook_dead_letters CASCADE"))
+            conn.execute(text("DROP TABLE IF EXISTS webhook_deliveries CASCADE"))
+            conn.execute(text("DROP TABLE IF EXISTS webhooks CASCADE"))
+            conn.execute(text("DROP TABLE IF EXISTS api_rate_limits CASCADE"))
+            conn.execute(text("DROP TABLE IF EXISTS user_writes CASCADE"))
+            conn.execute(text("DROP TABLE IF EXISTS telegram_flood_waits CASCADE"))
+            conn.execute(text("DROP TABLE IF EXISTS telegram_credential_stats CASCADE"))
+            conn.execute(text("DROP TABLE IF EXISTS receiver_jobs CASCADE"))
             conn.execute(text("DROP TABLE IF EXISTS verification_codes CASCADE"))
             conn.execute(text("DROP TABLE IF EXISTS accounts CASCADE"))
             conn.execute(text("DROP TABLE IF EXISTS users CASCADE"))
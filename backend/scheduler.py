@@ -1,24 +1,39 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 import asyncio
+import logging
 import config
 import receiver
+import jobs
+import profiling
 import random
 from datetime import datetime, timedelta, timezone
-from database import SessionLocal, VerificationCode
+from database import SessionLocal, Account, VerificationCode, ReceiverJob
+
+logger = logging.getLogger(__name__)
 
 scheduler = BackgroundScheduler()
 
+# API 进程的事件循环，本地保活任务提交到这里执行 (与手动检查共享 jobs.run_job 的合并和按账号串行)
+_loop = None
+
 def cleanup_old_codes():
-    """清理超过7天的验证码"""
+    """清理超过7天的验证码和已结束的任务记录"""
     db = SessionLocal()
     try:
         seven_days_ago = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=7)
         deleted_count = db.query(VerificationCode).filter(VerificationCode.received_at < seven_days_ago).delete()
+        # 每轮保活都会为每个账号写入一条任务记录，结束后只保留 7 天
+        deleted_jobs = db.query(ReceiverJob).filter(
+            ReceiverJob.status.in_(['done', 'failed']),
+            ReceiverJob.finished_at < seven_days_ago
+        ).delete(synchronize_session=False)
         db.commit()
         if deleted_count > 0:
-            print(f"🧹 已清理 {deleted_count} 条过期验证码")
+            logger.info(f"🧹 已清理 {deleted_count} 条过期验证码")
+        if deleted_jobs > 0:
+            logger.info(f"🧹 已清理 {deleted_jobs} 条已结束的任务记录")
     except Exception as e:
-        print(f"❌ 清理验证码失败: {e}")
+        logger.error(f"❌ 清理验证码失败: {e}")
     finally:
         db.close()
 
@@ -39,20 +54,39 @@ def schedule_next_job():
         name='账号保活任务',
         replace_existing=True
     )
-    print(f"📅 下次保活任务将于 {run_date.strftime('%Y-%m-%d %H:%M:%S')} 执行 (间隔 {interval/3600:.1f} 小时)")
+    logger.info(f"📅 下次保活任务将于 {run_date.strftime('%Y-%m-%d %H:%M:%S')} 执行 (间隔 {interval/3600:.1f} 小时)")
+
+def enqueue_keep_alive_jobs():
+    """Worker 模式下，将保活任务下发给各分片的 receiver_worker"""
+    db = SessionLocal()
+    try:
+        account_ids = [account_id for (account_id,) in db.query(Account.id).filter(Account.is_active == True).all()]
+        for account_id in account_ids:
+            jobs.enqueue_job(db, account_id, 'keep_alive')
+        logger.info(f"🔄 已下发 {len(account_ids)} 个账号保活任务")
+    finally:
+        db.close()
 
 def keep_alive_job():
     """定时任务：账号保活"""
-    asyncio.run(receiver.keep_alive_all_accounts())
+    with profiling.profiled('scheduler.keep_alive'):
+        if config.RECEIVER_SHARDS > 0:
+            enqueue_keep_alive_jobs()
+        elif _loop is not None:
+            asyncio.run_coroutine_threadsafe(receiver.keep_alive_all_accounts(), _loop).result()
+        else:
+            asyncio.run(receiver.keep_alive_all_accounts())
     schedule_next_job()
 
-def start_scheduler():
-    """启动调度器"""
+def start_scheduler(loop: asyncio.AbstractEventLoop = None):
+    """启动调度器，loop 为 API 进程的事件循环"""
+    global _loop
+    _loop = loop
     # 启动时先安排第一次任务
     schedule_next_job()
     
     # 每天执行一次清理任务
-    scheduler.add_job(cleanup_old_codes, 'interval', hours=24, id='cleanup_codes', name='清理过期验证码')
+    scheduler.add_job(cleanup_old_codes, 'interval', hours=24, id='cleanup_codes', name='清理过期验证码', replace_existing=True)
     
     scheduler.start()
-    print("✅ 调度器已启动，任务模式：随机 4-5 天保活 + 每日清理过期验证码")
+    logger.info("✅ 调度器已启动，任务模式：随机 4-5 天保活 + 每日清理过期验证码")
@@ -0,0 +1,263 @@
+"""Webhook 推送
+
+- store_code 保存新验证码时，在同一事务中为该用户的每个 Webhook 写入一条 webhook_deliveries 记录，
+  API 进程、调度器、receiver_worker 等任何入库路径都不会漏推
+- 推送循环定时认领到期记录，同一 Webhook 的多条验证码合并为一次请求，通过共享的连接池发送
+- 请求体使用 HMAC-SHA256 签名: X-Webhook-Signature = hex(hmac(secret, "{timestamp}.{body}"))
+- 失败后按指数退避重试，超过 WEBHOOK_MAX_ATTEMPTS 次后移入 webhook_dead_letters
+- 每次推送前重新解析目标主机，拒绝内网、本机、链路本地等地址 (防止借 Webhook 访问 Docker 内部服务)
+"""
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import socket
+import time
+from datetime import timedelta
+from urllib.parse import urlsplit
+import httpx
+from sqlalchemy import update
+import config
+from database import SessionLocal, Account, Webhook, WebhookDelivery, WebhookDeadLetter, utcnow
+
+logger = logging.getLogger(__name__)
+
+# 每轮最多认领的记录数
+CLAIM_LIMIT = 500
+
+class UnsafeWebhookURL(Exception):
+    """Webhook 地址指向不允许访问的网络"""
+
+def check_address(ip: str):
+    """只允许公网地址"""
+    address = ipaddress.ip_address(ip.split('%', 1)[0])
+    if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    if not address.is_global:
+        raise UnsafeWebhookURL(f"不允许推送到内网或保留地址 ({address})")
+
+async def check_url(url: str):
+    """解析 Webhook 主机并检查所有解析结果，主机在 WEBHOOK_ALLOWED_HOSTS 中时跳过检查"""
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise UnsafeWebhookURL("URL 必须以 http:// 或 https:// 开头")
+    allowed = {host.strip().lower() for host in config.WEBHOOK_ALLOWED_HOSTS.split(',') if host.strip()}
+    if parts.hostname in allowed:
+        return
+
+    try:
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        infos = await asyncio.get_running_loop().getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)
+    except (OSError, ValueError) as e:
+        raise UnsafeWebhookURL(f"无法解析主机 {parts.hostname}: {e}")
+    for info in infos:
+        check_address(info[4][0])
+
+def code_payload(code) -> dict:
+    return {
+        "id": code.id,
+        "account_id": code.account_id,
+        "phone": code.phone,
+        "code": code.code,
+        "message": code.message,
+        "service": code.service,
+        "received_at": code.received_at.isoformat()
+    }
+
+def enqueue_deliveries(db, code):
+    """为验证码所属用户的 Webhook 写入待推送记录 (由调用方提交事务)"""
+    if code.account_id is None:
+        return
+    webhook_ids = [webhook_id for (webhook_id,) in db.query(Webhook.id).join(
+        Account, Account.user_id == Webhook.user_id
+    ).filter(
+        Account.id == code.account_id,
+        Webhook.is_active == True
+    ).all()]
+    if not webhook_ids:
+        return
+
+    payload = json.dumps(code_payload(code), ensure_ascii=False)
+    now = utcnow()
+    for webhook_id in webhook_ids:
+        db.add(WebhookDelivery(webhook_id=webhook_id, payload=payload, next_attempt_at=now))
+
+def sign(secret: str, timestamp: str, body: bytes) -> str:
+    return hmac.new(secret.encode(), timestamp.encode() + b'.' + body, hashlib.sha256).hexdigest()
+
+def retry_delay(attempts: int) -> float:
+    """第 attempts 次失败后的重试间隔"""
+    return min(config.WEBHOOK_RETRY_MAX_DELAY, config.WEBHOOK_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+
+def _lease_until():
+    """租约截止时间 (足够发送一个批次)"""
+    return utcnow() + timedelta(seconds=config.WEBHOOK_TIMEOUT * 3)
+
+def claim_batches(db):
+    """认领到期的推送记录，返回 ({webhook_id: [批次, ...]}, 认领数量, 租约截止时间)
+
+    认领时将 next_attempt_at 推后作为租约，多个进程并发认领互不冲突；
+    进程在推送中途退出时，租约到期后记录会被重新认领。
+    租约截止时间同时作为持有凭证，续租时只续仍由本进程持有的记录。
+    """
+    now = utcnow()
+    deliveries = db.query(WebhookDelivery).filter(
+        WebhookDelivery.next_attempt_at <= now
+    ).order_by(WebhookDelivery.id).with_for_update(skip_locked=True).limit(CLAIM_LIMIT).all()
+
+    lease_until = _lease_until()
+    grouped = {}
+    for delivery in deliveries:
+        delivery.next_attempt_at = lease_until
+        grouped.setdefault(delivery.webhook_id, []).append((delivery.id, delivery.payload))
+    db.commit()
+
+    size = config.WEBHOOK_BATCH_SIZE
+    return {
+        webhook_id: [items[start:start + size] for start in range(0, len(items), size)]
+        for webhook_id, items in grouped.items()
+    }, len(deliveries), lease_until
+
+def renew_lease(db, delivery_ids, lease_until):
+    """为仍持有的记录续租，返回 (新的租约截止时间, 仍持有的记录 ID)"""
+    renewed = _lease_until()
+    owned = {delivery_id for (delivery_id,) in db.execute(
+        update(WebhookDelivery).where(
+            WebhookDelivery.id.in_(delivery_ids),
+            WebhookDelivery.next_attempt_at == lease_until
+        ).values(next_attempt_at=renewed).returning(WebhookDelivery.id)
+    )}
+    db.commit()
+    return renewed, owned
+
+def complete(db, delivery_ids):
+    db.query(WebhookDelivery).filter(
+        WebhookDelivery.id.in_(delivery_ids)
+    ).delete(synchronize_session=False)
+    db.commit()
+
+def fail(db, delivery_ids, error: str):
+    """记录失败：安排重试，或在重试次数用尽时移入死信表"""
+    now = utcnow()
+    dead = 0
+    for delivery in db.query(WebhookDelivery).filter(WebhookDelivery.id.in_(delivery_ids)).all():
+        delivery.attempts += 1
+        delivery.last_error = error
+        if delivery.attempts >= config.WEBHOOK_MAX_ATTEMPTS:
+            db.add(WebhookDeadLetter(
+                webhook_id=delivery.webhook_id,
+                payload=delivery.payload,
+                attempts=delivery.attempts,
+                last_error=error,
+                created_at=delivery.created_at
+            ))
+            db.delete(delivery)
+            dead += 1
+        else:
+            delivery.next_attempt_at = now + timedelta(seconds=retry_delay(delivery.attempts))
+    db.commit()
+    return dead
+
+def requeue_dead_letters(db, webhook_id: int) -> int:
+    """将死信重新放回推送队列，返回数量"""
+    letters = db.query(WebhookDeadLetter).filter(WebhookDeadLetter.webhook_id == webhook_id).all()
+    now = utcnow()
+    for letter in letters:
+        db.add(WebhookDelivery(webhook_id=webhook_id, payload=letter.payload, next_attempt_at=now))
+        db.delete(letter)
+    db.commit()
+    return len(letters)
+
+async def deliver(client: httpx.AsyncClient, webhook_id: int, items):
+    """推送一批验证码"""
+    delivery_ids = [delivery_id for delivery_id, _ in items]
+    db = SessionLocal()
+    try:
+        webhook = db.query(Webhook).filter(Webhook.id == webhook_id).first()
+        if webhook is None or not webhook.is_active:
+            complete(db, delivery_ids)
+            return
+        url, secret = webhook.url, webhook.secret
+    finally:
+        db.close()
+
+    # payload 已是 JSON，直接拼接避免重复解析
+    body = ('{"event": "codes", "webhook_id": %d, "codes": [%s]}' % (
+        webhook_id, ', '.join(payload for _, payload in items)
+    )).encode()
+    timestamp = str(int(time.time()))
+    started = time.perf_counter()
+    error = None
+    try:
+        # 推送时重新检查: DNS 记录可能在创建后被改为内网地址
+        await check_url(url)
+        response = await client.post(url, content=body, headers={
+            "Content-Type": "application/json",
+            "X-Webhook-Id": str(webhook_id),
+            "X-Webhook-Timestamp": timestamp,
+            "X-Webhook-Signature": f"sha256={sign(secret, timestamp, body)}",
+        })
+        if response.status_code >= 300:
+            error = f"HTTP {response.status_code}"
+    except UnsafeWebhookURL as e:
+        error = str(e)
+    except httpx.HTTPError as e:
+        error = f"{type(e).__name__}: {e}"
+
+    db = SessionLocal()
+    try:
+        if error is None:
+            complete(db, delivery_ids)
+            logger.info(f"📤 Webhook {webhook_id} 推送 {len(items)} 条验证码", extra={
+                "duration_ms": round((time.perf_counter() - started) * 1000)
+            })
+        else:
+            dead = fail(db, delivery_ids, error)
+            logger.warning(f"⚠️ Webhook {webhook_id} 推送失败 ({len(items)} 条，{dead} 条移入死信): {error}")
+    finally:
+        db.close()
+
+async def run_delivery_loop():
+    """推送循环 (在 API 进程中作为后台任务运行)"""
+    limits = httpx.Limits(
+        max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+        max_keepalive_connections=config.WEBHOOK_MAX_CONNECTIONS
+    )
+    async with httpx.AsyncClient(timeout=config.WEBHOOK_TIMEOUT, limits=limits) as client:
+        logger.info("📤 Webhook 推送循环已启动")
+        while True:
+            try:
+                db = SessionLocal()
+                try:
+                    batches, claimed, lease_until = claim_batches(db)
+                finally:
+                    db.close()
+                # 不同 Webhook 并发推送，同一 Webhook 的批次按顺序推送
+                await asyncio.gather(*(
+                    _deliver_in_order(client, webhook_id, chunks, lease_until) for webhook_id, chunks in batches.items()
+                ))
+                if claimed >= CLAIM_LIMIT:
+                    # 还有积压，立即继续
+                    continue
+            except Exception as e:
+                logger.exception(f"❌ Webhook 推送循环出错: {e}")
+            await asyncio.sleep(config.WEBHOOK_POLL_INTERVAL)
+
+async def _deliver_in_order(client: httpx.AsyncClient, webhook_id: int, chunks, lease_until):
+    for index, items in enumerate(chunks):
+        if index:
+            # 前面的批次可能已用掉大部分租约，发送前为剩余记录续租，
+            # 租约已过期并被其他进程重新认领的记录不再发送
+            db = SessionLocal()
+            try:
+                lease_until, owned = renew_lease(
+                    db, [delivery_id for chunk in chunks[index:] for delivery_id, _ in chunk], lease_until
+                )
+            finally:
+                db.close()
+            items = [item for item in items if item[0] in owned]
+            if not items:
+                continue
+        await deliver(client, webhook_id, items)
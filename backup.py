@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""Telegram 接码平台备份 / 恢复工具 (仅依赖 Python 标准库)
+
+用法:
+    python3 backup.py backup [--keep-days 7] [--bwlimit 20]
+    python3 backup.py restore backups/telegram-backup-YYYYMMDD-HHMMSS [--jobs 4]
+    python3 backup.py list
+
+- 数据库: pg_dump 自定义格式 (-Fc，自带压缩) 直接流式写入备份目录，不生成中间 SQL 文件
+- Session: 按内容哈希存入 backups/objects/ (gzip 压缩，多个备份共享)，每次只写入有变化的文件；
+  大小和修改时间与上次备份相同的文件沿用上次的哈希，不重新读取
+- 恢复: pg_restore -j 并行导入，内容未变化的 Session 文件直接跳过
+- 默认通过 docker-compose exec 在 postgres 容器内执行 pg_dump/pg_restore，
+  指定 --database-url 时直接使用本机的 pg_dump/pg_restore
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BACKUP_DIR = 'backups'
+SESSION_DIR = 'sessions'
+OBJECT_DIR = os.path.join(BACKUP_DIR, 'objects')
+PREFIX = 'telegram-backup-'
+CONFIG_FILES = ['.env', 'docker-compose.yml']
+CHUNK_SIZE = 1024 * 1024
+
+# 容器内用于并行恢复的临时文件
+CONTAINER_DUMP_PATH = '/tmp/telegram-restore.dump'
+
+def print_info(message):
+    print(f"ℹ️  {message}", flush=True)
+
+def print_success(message):
+    print(f"✅ {message}", flush=True)
+
+def format_throughput(nbytes: int, seconds: float) -> str:
+    mb = nbytes / 1024 / 1024
+    return f"{mb:.1f} MB，耗时 {seconds:.1f}s，{mb / max(seconds, 0.001):.1f} MB/s"
+
+def load_env(path: str = '.env') -> dict:
+    """读取 .env (只需要 DB_USER / DB_NAME，不依赖 python-dotenv)"""
+    env = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#') and '=' in line:
+                    key, value = line.split('=', 1)
+                    env[key.strip()] = value.strip().strip('"\'')
+    return env
+
+class Throttle:
+    """限制读取管道的速度 (MB/s)，pg_dump 会因管道反压随之降速，避免备份占满磁盘 I/O"""
+    def __init__(self, mb_per_second: float):
+        self.rate = mb_per_second * 1024 * 1024
+        self.started = time.monotonic()
+        self.consumed = 0
+
+    def consume(self, nbytes: int):
+        if not self.rate:
+            return
+        self.consumed += nbytes
+        ahead = self.consumed / self.rate - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+def pg_command(args, tool: str, *extra) -> list:
+    if args.database_url:
+        return [tool, f"--dbname={args.database_url}", *extra]
+    env = {**load_env(), **os.environ}
+    return [
+        'docker-compose', 'exec', '-T', args.service, tool,
+        '-U', env.get('DB_USER', 'telegram_user'),
+        '-d', env.get('DB_NAME', 'telegram_codes'),
+        *extra
+    ]
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def object_path(sha256: str) -> str:
+    return os.path.join(OBJECT_DIR, sha256[:2], f"{sha256}.gz")
+
+def write_object(sha256: str, data: bytes):
+    path = object_path(sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=6))
+    os.replace(tmp_path, path)
+
+def read_stable(path: str):
+    """读取文件内容和读取时的 stat；读取期间文件被修改 (Session 正在写入) 时重试"""
+    for _ in range(5):
+        before = os.stat(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        after = os.stat(path)
+        if (before.st_mtime_ns, before.st_size) == (after.st_mtime_ns, after.st_size):
+            return data, after
+        time.sleep(0.2)
+    return data, after
+
+def list_backups() -> list:
+    """已完成的备份目录 (按时间排序)"""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    return sorted(
+        os.path.join(BACKUP_DIR, name) for name in os.listdir(BACKUP_DIR)
+        if name.startswith(PREFIX) and not name.endswith('.partial')
+        and os.path.exists(os.path.join(BACKUP_DIR, name, 'manifest.json'))
+    )
+
+def load_manifest(backup_path: str) -> dict:
+    with open(os.path.join(backup_path, 'manifest.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+# --- 备份 ---
+
+def dump_database(args, backup_path: str) -> dict:
+    """pg_dump -Fc 流式写入 database.dump，同时计算哈希"""
+    print_info("备份数据库...")
+    extra = ['-Fc'] + (['-Z', str(args.compress)] if args.compress is not None else [])
+    path = os.path.join(backup_path, 'database.dump')
+    digest = hashlib.sha256()
+    size = 0
+    throttle = Throttle(args.bwlimit)
+    started = time.monotonic()
+
+    with subprocess.Popen(pg_command(args, 'pg_dump', *extra), stdout=subprocess.PIPE) as proc, open(path, 'wb') as f:
+        for chunk in iter(lambda: proc.stdout.read(CHUNK_SIZE), b''):
+            f.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+            throttle.consume(len(chunk))
+    if proc.returncode != 0:
+        raise RuntimeError(f"pg_dump 失败 (退出码 {proc.returncode})")
+
+    print_success(f"数据库备份完成: {format_throughput(size, time.monotonic() - started)}")
+    return {"file": "database.dump", "bytes": size, "sha256": digest.hexdigest()}
+
+def backup_sessions(previous: dict) -> dict:
+    """增量备份 Session 文件，返回 {文件名: {sha256, size, mtime_ns}}"""
+    print_info("备份 Session 文件...")
+    entries = {}
+    changed = unchanged = written = 0
+    started = time.monotonic()
+
+    names = sorted(name for name in os.listdir(SESSION_DIR) if name.endswith('.session')) if os.path.isdir(SESSION_DIR) else []
+    for name in names:
+        path = os.path.join(SESSION_DIR, name)
+        stat = os.stat(path)
+        prev = previous.get(name)
+        if (prev and prev['size'] == stat.st_size and prev['mtime_ns'] == stat.st_mtime_ns
+                and os.path.exists(object_path(prev['sha256']))):
+            entries[name] = prev
+            unchanged += 1
+            continue
+
+        data, stat = read_stable(path)
+        sha256 = hashlib.sha256(data).hexdigest()
+        if not os.path.exists(object_path(sha256)):
+            write_object(sha256, data)
+            written += len(data)
+        changed += 1
+        entries[name] = {"sha256": sha256, "size": len(data), "mtime_ns": stat.st_mtime_ns}
+
+    print_success(
+        f"Session 备份完成: {len(names)} 个文件，{changed} 个有变化，{unchanged} 个未变化；"
+        f"写入 {format_throughput(written, time.monotonic() - started)}"
+    )
+    return entries
+
+def prune(keep_days: int):
+    """删除过期备份 (至少保留最新一份)，并清理不再被引用的 Session 对象"""
+    backups = list_backups()
+    cutoff = datetime.now() - timedelta(days=keep_days)
+    removed = 0
+    for backup_path in backups[:-1]:
+        created = datetime.fromtimestamp(os.path.getmtime(os.path.join(backup_path, 'manifest.json')))
+        if created < cutoff:
+            shutil.rmtree(backup_path)
+            removed += 1
+
+    # 中断的备份
+    for name in os.listdir(BACKUP_DIR):
+        if name.startswith(PREFIX) and name.endswith('.partial'):
+            shutil.rmtree(os.path.join(BACKUP_DIR, name), ignore_errors=True)
+
+    referenced = set()
+    for backup_path in list_backups():
+        referenced.update(entry['sha256'] for entry in load_manifest(backup_path)['sessions'].values())
+    orphans = 0
+    if os.path.isdir(OBJECT_DIR):
+        for prefix in os.listdir(OBJECT_DIR):
+            for name in os.listdir(os.path.join(OBJECT_DIR, prefix)):
+                if name.split('.')[0] not in referenced:
+                    os.remove(os.path.join(OBJECT_DIR, prefix, name))
+                    orphans += 1
+    print_info(f"已清理 {removed} 个 {keep_days} 天前的旧备份，{orphans} 个不再引用的 Session 对象")
+
+def backup(args):
+    started = time.monotonic()
+    name = f"{PREFIX}{datetime.now():%Y%m%d-%H%M%S}"
+    final_path = os.path.join(BACKUP_DIR, name)
+    # 写入完成 (manifest.json 写好) 前使用 .partial 目录，中断的备份不会被当作有效备份
+    backup_path = f"{final_path}.partial"
+    os.makedirs(backup_path)
+    print_info(f"开始备份: {final_path}")
+
+    backups = list_backups()
+    previous = load_manifest(backups[-1])['sessions'] if backups else {}
+
+    manifest = {
+        "created_at": datetime.now().isoformat(timespec='seconds'),
+        "database": dump_database(args, backup_path),
+        "sessions": backup_sessions(previous),
+        "config": [],
+    }
+    for config_file in CONFIG_FILES:
+        if os.path.exists(config_file):
+            shutil.copy2(config_file, os.path.join(backup_path, os.path.basename(config_file)))
+            manifest["config"].append(os.path.basename(config_file))
+
+    with open(os.path.join(backup_path, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.rename(backup_path, final_path)
+
+    print_success(f"备份完成！耗时 {time.monotonic() - started:.1f}s")
+    print_info(f"备份目录: {final_path}")
+    if args.keep_days > 0:
+        prune(args.keep_days)
+
+    print()
+    print_info("恢复命令:")
+    print("  docker-compose stop backend")
+    print(f"  python3 backup.py restore {final_path} --jobs 4")
+    print("  docker-compose start backend")
+
+# --- 恢复 ---
+
+def restore_database(args, backup_path: str, manifest: dict):
+    path = os.path.join(backup_path, manifest['database']['file'])
+    if args.verify:
+        print_info("校验数据库备份...")
+        if sha256_file(path) != manifest['database']['sha256']:
+            raise RuntimeError(f"数据库备份已损坏 (哈希不一致): {path}")
+
+    print_info(f"恢复数据库 (并行 {args.jobs})...")
+    options = ['--clean', '--if-exists', '--no-owner']
+    size = os.path.getsize(path)
+    started = time.monotonic()
+
+    if args.database_url:
+        # 本机 pg_restore 直接读取备份文件
+        subprocess.run(pg_command(args, 'pg_restore', *options, '-j', str(args.jobs), path), check=True)
+    elif args.jobs > 1:
+        # 并行恢复需要可随机读取的文件，先复制到容器内
+        container = subprocess.run(
+            ['docker-compose', 'ps', '-q', args.service], check=True, capture_output=True, text=True
+        ).stdout.strip()
+        if not container:
+            raise RuntimeError(f"容器 {args.service} 未运行")
+        subprocess.run(['docker', 'cp', path, f"{container}:{CONTAINER_DUMP_PATH}"], check=True)
+        try:
+            subprocess.run(pg_command(args, 'pg_restore', *options, '-j', str(args.jobs), CONTAINER_DUMP_PATH), check=True)
+        finally:
+            subprocess.run(['docker-compose', 'exec', '-T', args.service, 'rm', '-f', CONTAINER_DUMP_PATH])
+    else:
+        with subprocess.Popen(pg_command(args, 'pg_restore', *options), stdin=subprocess.PIPE) as proc, open(path, 'rb') as f:
+            shutil.copyfileobj(f, proc.stdin, CHUNK_SIZE)
+            proc.stdin.close()
+        if proc.returncode != 0:
+            raise RuntimeError(f"pg_restore 失败 (退出码 {proc.returncode})")
+
+    print_success(f"数据库恢复完成: {format_throughput(size, time.monotonic() - started)}")
+
+def restore_sessions(manifest: dict):
+    print_info("恢复 Session 文件...")
+    os.makedirs(SESSION_DIR, exist_ok=True)
+    restored = skipped = written = 0
+    started = time.monotonic()
+
+    for name, entry in manifest['sessions'].items():
+        path = os.path.join(SESSION_DIR, name)
+        if os.path.exists(path) and os.path.getsize(path) == entry['size'] and sha256_file(path) == entry['sha256']:
+            skipped += 1
+            continue
+        with gzip.open(object_path(entry['sha256']), 'rb') as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != entry['sha256']:
+            raise RuntimeError(f"Session 备份已损坏: {name}")
+        tmp_path = f"{path}.restore"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        restored += 1
+        written += len(data)
+
+    print_success(
+        f"Session 恢复完成: {restored} 个已恢复，{skipped} 个未变化；"
+        f"写入 {format_throughput(written, time.monotonic() - started)}"
+    )
+
+def restore(args):
+    backup_path = args.backup
+    if not os.path.exists(os.path.join(backup_path, 'manifest.json')):
+        # 只给出备份名时在 backups/ 下查找
+        backup_path = os.path.join(BACKUP_DIR, os.path.basename(backup_path))
+    manifest = load_manifest(backup_path)
+    print_info(f"恢复备份: {backup_path} ({manifest['created_at']})")
+    started = time.monotonic()
+
+    if not args.skip_database:
+        restore_database(args, backup_path, manifest)
+    if not args.skip_sessions:
+        restore_sessions(manifest)
+
+    print_success(f"恢复完成！耗时 {time.monotonic() - started:.1f}s")
+    if manifest.get('config'):
+        print_info(f"配置文件未自动覆盖，如需恢复请从 {backup_path} 手动复制: {', '.join(manifest['config'])}")
+
+def list_command(args):
+    for backup_path in list_backups():
+        manifest = load_manifest(backup_path)
+        print(
+            f"{os.path.basename(backup_path)}  数据库 {manifest['database']['bytes'] / 1024 / 1024:.1f} MB  "
+            f"Session {len(manifest['sessions'])} 个"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Telegram 接码平台备份 / 恢复")
+    parser.add_argument('--database-url', help="直接使用本机 pg_dump/pg_restore 连接该数据库 (默认通过 docker-compose exec)")
+    parser.add_argument('--service', default='postgres', help="docker-compose 中的数据库服务名 (默认 postgres)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    backup_parser = subparsers.add_parser('backup', help="创建备份")
+    backup_parser.add_argument('--keep-days', type=int, default=7, help="保留最近几天的备份，0 表示不清理 (默认 7)")
+    backup_parser.add_argument('--bwlimit', type=float, default=0, help="数据库导出限速 MB/s，0 表示不限速")
+    backup_parser.add_argument('--compress', type=int, choices=range(0, 10), help="pg_dump 压缩级别 0-9 (默认由 pg_dump 决定)")
+    backup_parser.set_defaults(func=backup)
+
+    restore_parser = subparsers.add_parser('restore', help="从备份恢复")
+    restore_parser.add_argument('backup', help="备份目录，例如 backups/telegram-backup-20260101-020000")
+    restore_parser.add_argument('--jobs', '-j', type=int, default=4, help="pg_restore 并行数 (默认 4)")
+    restore_parser.add_argument('--no-verify', dest='verify', action='store_false', help="跳过数据库备份哈希校验")
+    restore_parser.add_argument('--skip-database', action='store_true', help="只恢复 Session 文件")
+    restore_parser.add_argument('--skip-sessions', action='store_true', help="只恢复数据库")
+    restore_parser.set_defaults(func=restore)
+
+    list_parser = subparsers.add_parser('list', help="列出已有备份")
+    list_parser.set_defaults(func=list_command)
+
+    args = parser.parse_args()
+    if args.command == 'restore':
+        args.backup = os.path.abspath(args.backup.rstrip('/'))
+    os.chdir(ROOT)
+    # 降低自身 CPU 优先级，减少对线上服务的影响
+    if hasattr(os, 'nice'):
+        os.nice(10)
+    try:
+        args.func(args)
+    except (RuntimeError, subprocess.CalledProcessError, FileNotFoundError) as e:
+        print(f"❌ {e}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()